@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Compares the throughput of the config writers:
+the plain streaming into the target file, the atomic replace and the journal of two files.
+
+Usage: python bench/bench_config_write.py [events] [writes]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calbot.conf import EventsConfigFile, FeedConfigFile, Journal
+
+
+def make_parser(events):
+    parser = ConfigParser(interpolation=None)
+    for i in range(events):
+        parser.read_dict(
+            {
+                "event%s@example.com" % i: {
+                    "last_notified": "24",
+                    "notify_datetime": "2024-01-01T10:00:00+00:00",
+                    "end": "2024-01-01T11:00:00+00:00",
+                }
+            }
+        )
+    return parser
+
+
+def write_plain(config_file, parser):
+    os.makedirs(os.path.dirname(config_file.path), exist_ok=True)
+    with open(config_file.path, "wt", encoding="UTF-8") as file:
+        parser.write(file)
+
+
+def write_atomic(config_file, parser):
+    config_file.write(parser)
+
+
+def write_journal(vardir, config_file, feed_file, parser):
+    with Journal(vardir) as journal:
+        journal.write(config_file, parser)
+        journal.write(feed_file, parser)
+
+
+def measure(name, writes, write):
+    start = time.perf_counter()
+    for _ in range(writes):
+        write()
+    elapsed = time.perf_counter() - start
+    print("%-10s %6d writes %8.3f s %10.1f writes/s" % (name, writes, elapsed, writes / elapsed))
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    parser = make_parser(events)
+    vardir = tempfile.mkdtemp()
+    try:
+        config_file = EventsConfigFile(vardir, "BENCH", "1")
+        feed_file = FeedConfigFile(vardir, "BENCH", "1")
+        print("events.cfg of %s events" % events)
+        measure("plain", writes, lambda: write_plain(config_file, parser))
+        measure("atomic", writes, lambda: write_atomic(config_file, parser))
+        measure("journal", writes, lambda: write_journal(vardir, config_file, feed_file, parser))
+    finally:
+        shutil.rmtree(vardir)
+
+
+if __name__ == "__main__":
+    main()
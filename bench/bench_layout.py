@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Compares the flat and sharded var directory layouts:
+the lookup and read of settings.cfg files of random users and the scan of all users.
+
+Usage: python bench/bench_layout.py [users] [lookups]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calbot import layout
+from calbot.conf import UserConfigFile
+
+
+def populate(vardir, users):
+    for i in range(users):
+        user_dir = os.path.join(vardir, str(100000000 + i))
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "settings.cfg"), "wt") as file:
+            file.write("[settings]\nadvance = 24\n")
+
+
+def measure(name, count, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print("%-18s %8d %8.3f s %12.1f /s" % (name, count, elapsed, count / elapsed))
+
+
+def lookup(vardir, user_ids):
+    for user_id in user_ids:
+        UserConfigFile(vardir, user_id).read_parser()
+
+
+def bench(name, vardir, user_ids):
+    measure(name + " lookup", len(user_ids), lambda: lookup(vardir, user_ids))
+    measure(name + " scan", 1, lambda: layout.user_ids(vardir))
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    user_ids = [str(100000000 + random.randrange(users)) for _ in range(lookups)]
+    vardir = tempfile.mkdtemp()
+    try:
+        print("%s users" % users)
+        populate(vardir, users)
+        bench("flat", vardir, user_ids)
+        measure("migrate", users, lambda: layout.migrate(vardir))
+        bench("sharded", vardir, user_ids)
+    finally:
+        shutil.rmtree(vardir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Measures the cost of the contention of the processes changing the calendars of the same user,
+with the files and SQLite storages.
+Each process adds the calendars, then all calendars are counted to check no update is lost.
+
+Usage: python bench/bench_locking.py [processes] [calendars per process]
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calbot.conf import Config
+
+
+def make_config(tmpdir, storage):
+    configfile = os.path.join(tmpdir, "calbot.cfg")
+    with open(configfile, "wt") as file:
+        file.write(
+            "[bot]\ntoken = TOKEN\nvardir = %s\nstorage = %s\n"
+            % (os.path.join(tmpdir, "var"), storage)
+        )
+    os.makedirs(os.path.join(tmpdir, "var"), exist_ok=True)
+    return configfile
+
+
+def add_calendars(configfile, calendars):
+    config = Config(configfile)
+    for i in range(calendars):
+        calendar = config.add_calendar("BENCH", "http://localhost/%s.ics" % i, "@channel")
+        config.enable_calendar("BENCH", calendar.id, False)
+
+
+def bench(storage, processes, calendars):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        configfile = make_config(tmpdir, storage)
+        Config(configfile)
+        workers = [
+            multiprocessing.Process(target=add_calendars, args=(configfile, calendars))
+            for _ in range(processes)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        count = len(list(Config(configfile).load_calendars("BENCH")))
+        updates = processes * calendars * 2
+        print(
+            "%-7s %3d processes %8.3f s %10.1f updates/s, %d of %d calendars"
+            % (storage, processes, elapsed, updates / elapsed, count, processes * calendars)
+        )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    calendars = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    for storage in ("files", "sqlite"):
+        bench(storage, 1, calendars * processes)
+        bench(storage, processes, calendars)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Measures the memory taken by the calendars configs with the tracked events
+loaded from the synthetic var directory.
+
+Usage: python bench/bench_memory.py [calendars] [events per calendar]
+"""
+
+import gc
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calbot.conf import Config
+
+USERS_CALENDARS = 5
+
+
+def populate(vardir, calendars, events):
+    for i in range(calendars):
+        user_id = str(100000000 + i // USERS_CALENDARS)
+        cal_id = str(i % USERS_CALENDARS + 1)
+        user_dir = os.path.join(vardir, user_id)
+        os.makedirs(os.path.join(user_dir, cal_id))
+        with open(os.path.join(user_dir, "calendars.cfg"), "at") as file:
+            file.write("[%s]\nurl = http://localhost/%s.ics\nchannel_id = @channel\n" % (cal_id, i))
+        with open(os.path.join(user_dir, cal_id, "events.cfg"), "wt") as file:
+            for j in range(events):
+                file.write(
+                    "[event%s@example.com_2024-01-01T10:00:00+00:00]\n"
+                    "last_notified = 24\n"
+                    "notify_datetime = 2024-01-01T10:00:00+00:00\n"
+                    "end = 2024-01-01T11:00:00+00:00\n\n" % j
+                )
+
+
+def rss():
+    """
+    Current resident memory in bytes, the peak one if the current is unknown.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    calendars = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        vardir = os.path.join(tmpdir, "var")
+        configfile = os.path.join(tmpdir, "calbot.cfg")
+        with open(configfile, "wt") as file:
+            file.write("[bot]\ntoken = TOKEN\nvardir = %s\n" % vardir)
+        os.makedirs(vardir)
+        populate(vardir, calendars, events)
+
+        config = Config(configfile)
+        config.storage.registry()
+        gc.collect()
+        before = rss()
+        start = time.perf_counter()
+        loaded = list(config.all_calendars())
+        for calendar in loaded:
+            calendar.load_events()
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        used = rss() - before
+
+        total = sum(len(calendar.events) for calendar in loaded)
+        print("%s calendars, %s events loaded in %.1f s" % (len(loaded), total, elapsed))
+        print("resident memory: %.1f MiB, %.0f bytes per event" % (used / 2 ** 20, used / max(total, 1)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
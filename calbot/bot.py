@@ -19,6 +19,8 @@
 # -*- coding: utf-8 -*-
 
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
 from functools import partial
 
 from telegram import Update
@@ -35,7 +37,12 @@ from calbot.commands import add as add_command
 from calbot.commands import cal as cal_command
 from calbot.commands import format as format_command
 from calbot.commands import advance as advance_command
+from calbot.conf import Journal
+from calbot.history import StatsHistory
+from calbot.ical import expanded_calendars, parsed_calendars
+from calbot.metrics import MetricsServer
 from calbot.processing import update_calendars_job
+from calbot.scheduler import NotificationScheduler
 
 __all__ = ["run_bot"]
 
@@ -46,11 +53,35 @@ GREETING = """Hello, I'm calendar bot, please give me some commands.
 /advance — get and set calendar events advance, i.e. how many hours before the event to publish it
 """
 
+DEFAULT_COSTS_TOP = 10
+
+MAX_COSTS_TOP = 50
+
+MAX_MESSAGE_LENGTH = 4096
+
 logger = logging.getLogger("bot")
 
 
 def run_bot(config):
-    application = Application.builder().token(config.token).build()
+    # completes the files replacements interrupted by the previous run
+    Journal.recover(config.vardir)
+
+    application = (
+        Application.builder()
+        .token(config.token)
+        .post_shutdown(partial(shutdown, config=config))
+        .build()
+    )
+
+    if config.parse_processes > 0:
+        application.bot_data["executor"] = ProcessPoolExecutor(config.parse_processes)
+    parsed_calendars.maxsize = config.parsed_cache_size
+    expanded_calendars.maxsize = config.expanded_cache_size
+
+    if config.metrics_port > 0:
+        metrics_server = MetricsServer(config.metrics_listen, config.metrics_port)
+        metrics_server.start()
+        application.bot_data["metrics_server"] = metrics_server
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", start))
@@ -66,6 +97,8 @@ def run_bot(config):
     application.add_handler(advance_command.create_handler(config))
 
     application.add_handler(CommandHandler("stats", partial(get_stats, config=config)))
+    application.add_handler(CommandHandler("costs", partial(get_costs, config=config)))
+    application.add_handler(CommandHandler("history", partial(get_history, config=config)))
 
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(MessageHandler(filters.COMMAND, unknown))
@@ -73,9 +106,14 @@ def run_bot(config):
     application.add_error_handler(error)
 
     # Job queue
+    # each calendar is reread in its own interval, adapted to the changes of the ical file,
+    # the notifications are sent by the scheduler exactly in time
+    application.bot_data["scheduler"] = NotificationScheduler(
+        application.job_queue, timedelta(seconds=config.max_interval)
+    )
     application.job_queue.run_repeating(
         update_calendars_job,
-        interval=config.interval,
+        interval=config.min_interval,
         first=0,
         data=config,
     )
@@ -98,6 +136,17 @@ def run_bot(config):
         logger.info("Started polling")
 
 
+async def shutdown(application: Application, config):
+    executor = application.bot_data.get("executor")
+    if executor is not None:
+        executor.shutdown()
+    config.storage.flush()
+    config.stats.flush()
+    metrics_server = application.bot_data.get("metrics_server")
+    if metrics_server is not None:
+        metrics_server.stop()
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Started from %s", update.effective_chat.id)
     await update.message.reply_text(GREETING)
@@ -123,6 +172,35 @@ async def get_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, config):
     await update.message.reply_text(text)
 
 
+async def get_costs(update: Update, context: ContextTypes.DEFAULT_TYPE, config):
+    if not await check_admin(update, context, config):
+        return
+    try:
+        top = int(context.args[0]) if context.args else DEFAULT_COSTS_TOP
+    except ValueError:
+        await update.message.reply_text("Usage: /costs [number of calendars]")
+        return
+    text = str(stats.get_costs(config, min(max(top, 1), MAX_COSTS_TOP)))
+    await update.message.reply_text(text[:MAX_MESSAGE_LENGTH])
+
+
+async def get_history(update: Update, context: ContextTypes.DEFAULT_TYPE, config):
+    if not await check_admin(update, context, config):
+        return
+    await update.message.reply_text(StatsHistory(config.vardir).summaries())
+
+
+async def check_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, config):
+    """
+    Checks the command is sent by the admin, other users get the reply as for an unknown command.
+    :return: True if the user is the admin
+    """
+    if str(update.effective_chat.id) in config.admins:
+        return True
+    await unknown(update, context)
+    return False
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Sorry, there's nothing to cancel.")
 
@@ -102,6 +102,9 @@ async def set_advance(update: Update, context: ContextTypes.DEFAULT_TYPE, config
 
         hours = update.message.text.split()
         user_config.set_advance(hours)
+        scheduler = context.bot_data.get("scheduler")
+        if scheduler is not None:
+            scheduler.update_advance(user_id, user_config.advance)
 
         text = (
             "Advance hours are updated.\n"
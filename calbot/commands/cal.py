@@ -135,6 +135,9 @@ async def del_cal(update: Update, context: ContextTypes.DEFAULT_TYPE, config):
                 and job.data.id == calendar_id
             ):
                 job.schedule_removal()
+        scheduler = context.bot_data.get("scheduler")
+        if scheduler is not None:
+            scheduler.drop(user_id, calendar_id)
 
         await update.message.reply_text(f"Calendar {calendar_id} is deleted")
 
@@ -265,6 +268,9 @@ async def disable_cal(update, context, config):
 
     try:
         config.enable_calendar(user_id, calendar_id, False)
+        scheduler = context.bot_data.get("scheduler")
+        if scheduler is not None:
+            scheduler.drop(user_id, calendar_id)
         await update.message.reply_text(f"Calendar /cal{calendar_id} is disabled")
     except Exception as e:
         logger.warning(
@@ -28,20 +28,47 @@ var/
         calendars.cfg - the list of user's calendars
         calendar1_id/
             events.cfg - the list of calendar events
+            events.log - the notifications made after events.cfg was saved
+            feed.cfg - HTTP validators of the last downloaded ical file
+            feed.ics - the last downloaded ical file
         calendar2_id/
         ...
     user2_chat_id/
     ...
+    registry.cfg - the index of the calendars of all users
+    stats.cfg - the statistics counters
+    stats.history - the ring buffer of the processing cycles, see calbot.history
+    journal/ - the lists of files being replaced together
 ```
+
+The users directories can be sharded as `var/users/ab/cd/user1_chat_id/`, see calbot.layout.
+
+With `storage = sqlite` the settings, calendars and events are stored in the SQLite database instead,
+see calbot.db, the feed files are still stored in the calendars directories.
 """
 
 from configparser import ConfigParser
+import copy
+import json
 import logging
 import os
-from datetime import time, datetime
+import sys
+import tempfile
+from contextlib import contextmanager, nullcontext
+from datetime import time, datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, the files are not locked there
+    fcntl = None
+
+from calbot import layout
+from calbot.db import SqliteStorage
+from calbot.ical import EXPANDED_CACHE_SIZE, PARSED_CACHE_SIZE
+from calbot.registry import RegistryEntry, check_due
 
 
-__all__ = ["Config", "ConfigFile"]
+__all__ = ["Config", "ConfigFile", "StatsCounters"]
 
 logger = logging.getLogger("conf")
 
@@ -52,8 +79,22 @@ DEFAULT_FORMAT = """{title}
 
 DEFAULT_ADVANCE = [48, 24]
 
+DEFAULT_DAY_START = time(10, 0)
+
 DEFAULT_ERRORS_COUNT_THRESHOLD = 12
 
+DEFAULT_MAX_ICAL_SIZE = 20 * 1024 * 1024
+
+DEFAULT_MAX_INTERVAL = 24 * 3600
+
+UNCHANGED_CHECKS_TO_SLOW_DOWN = 3
+
+DEFAULT_EVENTS_RETENTION = 7 * 24 * 3600
+
+DEFAULT_STATS_INTERVAL = 24 * 3600
+
+COST_SMOOTHING = 0.2
+
 
 class Config:
     """
@@ -69,16 +110,61 @@ class Config:
         config.read(configfile)
         self.vardir = config.get("bot", "vardir")
         """path to var directory, where current state is stored"""
+        storage = config.get("bot", "storage", fallback="files")
+        if storage == "sqlite":
+            self.storage = SqliteStorage(
+                config.get("bot", "database", fallback=os.path.join(self.vardir, "calbot.db"))
+            )
+            if not self.storage.imported:
+                # one-shot migration of the existing var directory, retried until it's complete
+                os.makedirs(self.vardir, exist_ok=True)
+                self.storage.import_files(FileStorage(self.vardir))
+        elif storage == "files":
+            self.storage = FileStorage(self.vardir)
+        else:
+            raise ValueError("Unknown storage %s" % storage)
+        """storage of users, calendars and events configs"""
+        self.stats = StatsCounters(self.vardir)
+        """statistics counters, updated by the changes of the calendars and events"""
         self.token = config.get("bot", "token")
         """the bot token"""
         self.interval = config.getint("bot", "interval", fallback=3600)
         """the interval to reread calendars, in seconds"""
+        self.min_interval = config.getint("bot", "min_interval", fallback=self.interval)
+        """the shortest interval to reread a calendar which content changes, in seconds"""
+        self.max_interval = max(
+            config.getint("bot", "max_interval", fallback=DEFAULT_MAX_INTERVAL),
+            self.min_interval,
+        )
+        """the longest interval to reread a calendar which content doesn't change, in seconds"""
+        self.events_retention = config.getint(
+            "bot", "events_retention", fallback=DEFAULT_EVENTS_RETENTION
+        )
+        """how long to keep the state of the notified events after they ended, in seconds"""
+        self.stats_interval = config.getint("bot", "stats_interval", fallback=DEFAULT_STATS_INTERVAL)
+        """how often the statistics counters are recalculated from all calendars, in seconds"""
         self.bootstrap_retries = config.getint("bot", "bootstrap_retries", fallback=0)
         """Whether the bootstrapping phase of the Updater will retry on failures on the Telegram server."""
         self.errors_count_threshold = config.getint(
             "bot", "errors_count_threshold", fallback=DEFAULT_ERRORS_COUNT_THRESHOLD
         )
         """Disable a calendar if it processing attempts failed with so many errors"""
+        self.concurrency = max(config.getint("bot", "concurrency", fallback=10), 1)
+        """How many calendars are fetched and processed at the same time"""
+        self.parse_processes = config.getint("bot", "parse_processes", fallback=0)
+        """How many processes parse calendars, 0 to parse them in threads"""
+        self.max_ical_size = config.getint(
+            "bot", "max_ical_size", fallback=DEFAULT_MAX_ICAL_SIZE
+        )
+        """Max size of the ical file in bytes, larger files are not read"""
+        self.parsed_cache_size = config.getint("bot", "parsed_cache_size", fallback=PARSED_CACHE_SIZE)
+        """How many parsed ical files are kept in memory, the unchanged files kept are not parsed again"""
+        self.expanded_cache_size = config.getint("bot", "expanded_cache_size", fallback=EXPANDED_CACHE_SIZE)
+        """How many expansions of the parsed ical files are kept in memory"""
+        self.admins = set(config.get("bot", "admins", fallback="").replace(",", " ").split())
+        """Chat IDs of the users allowed to run the admin commands"""
+        self.lateness_alert = config.getint("bot", "lateness_alert", fallback=0)
+        """Alert the admins when 95% of the notifications are late more than so many seconds, 0 to not alert"""
 
         self.poll_interval = config.getfloat("polling", "poll_interval", fallback=0.0)
         """Time to wait between polling updates from Telegram"""
@@ -96,6 +182,11 @@ class Config:
         self.port = config.getint("webhook", "port", fallback=5000)
         """webhook port"""
 
+        self.metrics_port = config.getint("metrics", "port", fallback=0)
+        """port to serve the metrics in Prometheus text format, 0 to not serve them"""
+        self.metrics_listen = config.get("metrics", "listen", fallback="127.0.0.1")
+        """IP address to listen by the metrics server"""
+
     def user_calendars(self, user_id):
         """
         Returns list of calendars configured for the user
@@ -107,15 +198,13 @@ class Config:
 
     def all_calendars(self):
         """
-        Returns list of all known and monitoring calendars with events
+        Returns list of all known and monitoring calendars,
+        the events are loaded on first access
         :return: list of CalendarConfig
         """
-        for name in os.listdir(self.vardir):
-            if os.path.isdir(os.path.join(self.vardir, name)):
-                user_id = name
-                for calendar in self.load_calendars(user_id):
-                    calendar.load_events()
-                    yield calendar
+        for user_id in self.storage.user_ids():
+            for calendar in self.load_calendars(user_id):
+                yield calendar
 
     def load_user(self, user_id):
         """
@@ -123,7 +212,7 @@ class Config:
         :param user_id: ID of the user
         :return: UserConfig instance
         """
-        parser = UserConfigFile(self.vardir, user_id).read_parser()
+        parser = self.storage.user_file(user_id).read_parser()
         return UserConfig.load(self, user_id, parser)
 
     def load_calendars(self, user_id):
@@ -133,13 +222,42 @@ class Config:
         :return: yields the CalendarConfig instances
         """
         user_config = self.load_user(user_id)
-        calendar_parser = CalendarsConfigFile(self.vardir, user_id).read_parser()
+        calendar_parser = self.storage.calendars_file(user_id).read_parser()
 
         for section in calendar_parser.sections():
             if section != "settings":
                 calendar = CalendarConfig.load(user_config, calendar_parser, section)
                 yield calendar
 
+    def load_registered_calendars(self, entries):
+        """
+        Loads the calendars listed in the registry, the events are loaded on first access.
+        :param entries: iterable of RegistryEntry
+        :return: yields the CalendarConfig instances
+        """
+        users = {}
+        for entry in entries:
+            users.setdefault(entry.user_id, []).append(entry.cal_id)
+        for user_id, cal_ids in users.items():
+            user_config = self.load_user(user_id)
+            calendar_parser = self.storage.calendars_file(user_id).read_parser()
+            for cal_id in cal_ids:
+                if calendar_parser.has_section(cal_id):
+                    calendar = CalendarConfig.load(user_config, calendar_parser, cal_id)
+                    yield calendar
+
+    @contextmanager
+    def delayed_writes(self):
+        """
+        Creates the copy of the config which storage delays the writes until the end of the block.
+        Only the configs loaded by the copy write behind, other writes are not delayed.
+        :return: context manager of the Config
+        """
+        with self.storage.delayed_writes() as storage:
+            config = copy.copy(self)
+            config.storage = storage
+            yield config
+
     def load_calendar(self, user_id, calendar_id):
         """
         Loads one calendar of the specified user.
@@ -148,7 +266,7 @@ class Config:
         :return: the CalendarConfig instance
         """
         user_config = self.load_user(user_id)
-        calendar_parser = CalendarsConfigFile(self.vardir, user_id).read_parser()
+        calendar_parser = self.storage.calendars_file(user_id).read_parser()
 
         if not calendar_parser.has_section(calendar_id):
             raise KeyError("Calendar %s not found" % calendar_id)
@@ -164,23 +282,26 @@ class Config:
         :param channel_id: ID of the channel where to send calendar events
         :return: CalendarConfig instance
         """
-        calendar_config_file = CalendarsConfigFile(self.vardir, user_id)
-        calendar_parser = calendar_config_file.read_parser()
-        user_parser = UserConfigFile(self.vardir, user_id).read_parser()
-        user = UserConfig.load(self, user_id, user_parser)
+        with self.storage.locked(user_id):
+            calendar_config_file = self.storage.calendars_file(user_id)
+            calendar_parser = calendar_config_file.read_parser()
+            user_parser = self.storage.user_file(user_id).read_parser()
+            user = UserConfig.load(self, user_id, user_parser)
 
-        next_id = str(calendar_parser.getint("settings", "last_id", fallback=0) + 1)
-        if not calendar_parser.has_section("settings"):
-            calendar_parser.add_section("settings")
-        calendar_parser.set("settings", "last_id", next_id)
+            first = not _has_calendars(calendar_parser)
+            next_id = str(calendar_parser.getint("settings", "last_id", fallback=0) + 1)
+            if not calendar_parser.has_section("settings"):
+                calendar_parser.add_section("settings")
+            calendar_parser.set("settings", "last_id", next_id)
 
-        calendar = CalendarConfig.new(user, next_id, url, channel_id)
-        calendar_parser.add_section(next_id)
-        calendar_parser.set(next_id, "url", url)
-        calendar_parser.set(next_id, "channel_id", channel_id)
-        calendar_parser.set(next_id, "verified", "false")
+            calendar = CalendarConfig.new(user, next_id, url, channel_id)
+            calendar_parser.add_section(next_id)
+            calendar_parser.set(next_id, "url", url)
+            calendar_parser.set(next_id, "channel_id", channel_id)
+            calendar_parser.set(next_id, "verified", "false")
 
-        calendar_config_file.write(calendar_parser)
+            calendar_config_file.write(calendar_parser)
+            self.stats.calendar_added(True, first)
 
         return calendar
 
@@ -221,14 +342,18 @@ class Config:
         :param calendar_id: id of the calendar
         :return: None
         """
-        config_file = CalendarsConfigFile(self.vardir, user_id)
-        config_parser = config_file.read_parser()
+        with self.storage.locked(user_id):
+            config_file = self.storage.calendars_file(user_id)
+            config_parser = config_file.read_parser()
 
-        if not config_parser.has_section(calendar_id):
-            raise KeyError("%s not found" % calendar_id)
-        config_parser.remove_section(calendar_id)
+            if not config_parser.has_section(calendar_id):
+                raise KeyError("%s not found" % calendar_id)
+            enabled = config_parser.getboolean(calendar_id, "enabled", fallback=True)
+            events = config_parser.getint(calendar_id, "events_count", fallback=0)
+            config_parser.remove_section(calendar_id)
 
-        config_file.write(config_parser)
+            config_file.write(config_parser)
+            self.stats.calendar_deleted(enabled, events, not _has_calendars(config_parser))
 
     def enable_calendar(self, user_id, calendar_id, enabled):
         """
@@ -238,14 +363,20 @@ class Config:
         :param enabled: enabled flag
         :return: None
         """
-        config_file = CalendarsConfigFile(self.vardir, user_id)
-        config_parser = config_file.read_parser()
-        if not config_parser.has_section(calendar_id):
-            raise KeyError("%s not found" % calendar_id)
+        with self.storage.locked(user_id):
+            config_file = self.storage.calendars_file(user_id)
+            config_parser = config_file.read_parser()
+            if not config_parser.has_section(calendar_id):
+                raise KeyError("%s not found" % calendar_id)
 
-        config_parser.set(calendar_id, "enabled", str(enabled))
+            previous = config_parser.getboolean(calendar_id, "enabled", fallback=True)
+            config_parser.set(calendar_id, "enabled", str(enabled))
 
-        config_file.write(config_parser)
+            config_file.write(config_parser)
+            if enabled != previous:
+                self.stats.calendar_enabled(
+                    enabled, config_parser.getint(calendar_id, "events_count", fallback=0)
+                )
 
 
 class UserConfig:
@@ -264,12 +395,24 @@ class UserConfig:
         """Language to format the event"""
         self.advance = kwargs["advance"]
         """Array of hours for advance the calendar event"""
+        self.storage = kwargs.get("storage") or FileStorage(self.vardir)
+        """Storage of the configs"""
+        self.stats = kwargs.get("stats") or StatsCounters(self.vardir)
+        """Statistics counters"""
         self.config_parser = kwargs.get("config_parser", None)
         """ConfigParser from which this object was loaded, None if this is new a config"""
         self.errors_count_threshold = kwargs.get(
             "errors_count_threshold", DEFAULT_ERRORS_COUNT_THRESHOLD
         )
         """Disable a calendar if it processing attempts failed with so many errors"""
+        self.max_ical_size = kwargs.get("max_ical_size", DEFAULT_MAX_ICAL_SIZE)
+        """Max size of the ical file in bytes"""
+        self.min_interval = kwargs["min_interval"]
+        """The shortest interval to reread a calendar, in seconds"""
+        self.max_interval = kwargs.get("max_interval", DEFAULT_MAX_INTERVAL)
+        """The longest interval to reread a calendar, in seconds"""
+        self.events_retention = kwargs.get("events_retention", DEFAULT_EVENTS_RETENTION)
+        """How long to keep the state of the notified events after they ended, in seconds"""
 
     @classmethod
     def new(cls, config, user_id):
@@ -281,11 +424,17 @@ class UserConfig:
         """
         return cls(
             vardir=config.vardir,
+            storage=config.storage,
+            stats=config.stats,
             user_id=user_id,
             format=DEFAULT_FORMAT,
             language=None,
             advance=DEFAULT_ADVANCE,
             errors_count_threshold=config.errors_count_threshold,
+            max_ical_size=config.max_ical_size,
+            min_interval=config.min_interval,
+            max_interval=config.max_interval,
+            events_retention=config.events_retention,
         )
 
     @classmethod
@@ -299,6 +448,8 @@ class UserConfig:
         """
         return cls(
             vardir=config.vardir,
+            storage=config.storage,
+            stats=config.stats,
             user_id=user_id,
             format=config_parser.get("settings", "format", fallback=DEFAULT_FORMAT),
             language=config_parser.get("settings", "language", fallback=None),
@@ -314,6 +465,10 @@ class UserConfig:
             ),
             config_parser=config_parser,
             errors_count_threshold=config.errors_count_threshold,
+            max_ical_size=config.max_ical_size,
+            min_interval=config.min_interval,
+            max_interval=config.max_interval,
+            events_retention=config.events_retention,
         )
 
     def set_format(self, format):
@@ -322,12 +477,13 @@ class UserConfig:
         :param format: new format
         :return: None
         """
-        config_file = UserConfigFile(self.vardir, self.id)
-        parser = self.config_parser or config_file.read_parser()
-        if not parser.has_section("settings"):
-            parser.add_section("settings")
-        parser.set("settings", "format", format)
-        config_file.write(parser)
+        with self.storage.locked(self.id):
+            config_file = self.storage.user_file(self.id)
+            parser = config_file.read_parser()
+            if not parser.has_section("settings"):
+                parser.add_section("settings")
+            parser.set("settings", "format", format)
+            config_file.write(parser)
         self.format = format
 
     def set_language(self, language):
@@ -336,12 +492,13 @@ class UserConfig:
         :param language: new language
         :return: None
         """
-        config_file = UserConfigFile(self.vardir, self.id)
-        parser = self.config_parser or config_file.read_parser()
-        if not parser.has_section("settings"):
-            parser.add_section("settings")
-        parser.set("settings", "language", language)
-        config_file.write(parser)
+        with self.storage.locked(self.id):
+            config_file = self.storage.user_file(self.id)
+            parser = config_file.read_parser()
+            if not parser.has_section("settings"):
+                parser.add_section("settings")
+            parser.set("settings", "language", language)
+            config_file.write(parser)
         self.language = language
 
     def set_advance(self, hours):
@@ -350,13 +507,14 @@ class UserConfig:
         :param hours: advance hours
         :return: None
         """
-        config_file = UserConfigFile(self.vardir, self.id)
-        parser = self.config_parser or config_file.read_parser()
-        if not parser.has_section("settings"):
-            parser.add_section("settings")
-        int_hours = sorted(set(map(int, hours)), reverse=True)
-        parser.set("settings", "advance", " ".join(map(str, int_hours)))
-        config_file.write(parser)
+        with self.storage.locked(self.id):
+            config_file = self.storage.user_file(self.id)
+            parser = config_file.read_parser()
+            if not parser.has_section("settings"):
+                parser.add_section("settings")
+            int_hours = sorted(set(map(int, hours)), reverse=True)
+            parser.set("settings", "advance", " ".join(map(str, int_hours)))
+            config_file.write(parser)
         self.advance = int_hours
 
 
@@ -365,12 +523,48 @@ class CalendarConfig:
     Current persisted calendar state.
     """
 
+    __slots__ = (
+        "vardir",
+        "storage",
+        "stats",
+        "id",
+        "user_id",
+        "url",
+        "name",
+        "channel_id",
+        "verified",
+        "enabled",
+        "format",
+        "language",
+        "advance",
+        "day_start",
+        "_events",
+        "_events_count",
+        "last_process_at",
+        "last_process_error",
+        "last_errors_count",
+        "errors_count_threshold",
+        "max_ical_size",
+        "min_interval",
+        "max_interval",
+        "events_retention",
+        "check_interval",
+        "unchanged_checks",
+        "next_check_at",
+        "cost",
+        "persisted",
+    )
+
     def __init__(self, **kwargs):
         self.vardir = kwargs["vardir"]
         """Base var directory"""
-        self.id = kwargs["cal_id"]
+        self.storage = kwargs.get("storage") or FileStorage(self.vardir)
+        """Storage of the configs"""
+        self.stats = kwargs.get("stats") or StatsCounters(self.vardir)
+        """Statistics counters"""
+        self.id = sys.intern(kwargs["cal_id"])
         """Current calendar ID"""
-        self.user_id = kwargs["user_id"]
+        self.user_id = sys.intern(kwargs["user_id"])
         """Chat ID of the user to whom this calendar belongs to"""
         self.url = kwargs["url"]
         """Url of the ical file to download"""
@@ -388,10 +582,12 @@ class CalendarConfig:
         """Language for the event"""
         self.advance = kwargs["advance"]
         """Array of the numbers: how many hours in advance notify about the event"""
-        self.day_start = time(10, 0)
+        self.day_start = DEFAULT_DAY_START
         """When the day starts if the event has no specified time"""
-        self.events = {}
-        """Dictionary of known configured events"""
+        self._events = None
+        """Dictionary of known configured events, None until loaded"""
+        self._events_count = kwargs.get("events_count")
+        """Number of the notified events persisted by the last save_events(), can be None"""
         self.last_process_at = kwargs.get("last_process_at")
         """Moment when the calendar was processed last time"""
         self.last_process_error = kwargs.get("last_process_error")
@@ -401,6 +597,27 @@ class CalendarConfig:
         self.errors_count_threshold = kwargs.get(
             "errors_count_threshold", DEFAULT_ERRORS_COUNT_THRESHOLD
         )
+        self.max_ical_size = kwargs.get("max_ical_size", DEFAULT_MAX_ICAL_SIZE)
+        """Max size of the ical file in bytes"""
+        self.min_interval = kwargs["min_interval"]
+        """The shortest interval to reread the calendar, in seconds"""
+        self.max_interval = kwargs.get("max_interval", DEFAULT_MAX_INTERVAL)
+        """The longest interval to reread the calendar, in seconds"""
+        self.events_retention = kwargs.get("events_retention", DEFAULT_EVENTS_RETENTION)
+        """How long to keep the state of the notified events after they ended, in seconds"""
+        self.check_interval = min(
+            max(kwargs.get("check_interval", self.min_interval), self.min_interval),
+            self.max_interval,
+        )
+        """Current interval to reread the calendar, in seconds, adapts to the changes of the ical file"""
+        self.unchanged_checks = kwargs.get("unchanged_checks", 0)
+        """How many times in a row the ical file was read unchanged"""
+        self.next_check_at = kwargs.get("next_check_at")
+        """Moment when the calendar should be read next time, None to read it as soon as possible"""
+        self.cost = kwargs.get("cost") or CalendarCost()
+        """Cost of the processing of the calendar"""
+        self.persisted = kwargs.get("persisted", False)
+        """Flag the calendar section exists in calendars.cfg, its later absence means the calendar was deleted"""
 
     @classmethod
     def new(cls, user_config, cal_id, url, channel_id):
@@ -414,6 +631,8 @@ class CalendarConfig:
         """
         return cls(
             vardir=user_config.vardir,
+            storage=user_config.storage,
+            stats=user_config.stats,
             user_id=user_config.id,
             format=user_config.format,
             language=user_config.language,
@@ -425,6 +644,10 @@ class CalendarConfig:
             verified=False,
             enabled=True,
             errors_count_threshold=user_config.errors_count_threshold,
+            max_ical_size=user_config.max_ical_size,
+            min_interval=user_config.min_interval,
+            max_interval=user_config.max_interval,
+            events_retention=user_config.events_retention,
         )
 
     @classmethod
@@ -441,6 +664,8 @@ class CalendarConfig:
         enabled = config_parser.getboolean(section, "enabled", fallback=True)
         return cls(
             vardir=user_config.vardir,
+            storage=user_config.storage,
+            stats=user_config.stats,
             user_id=user_config.id,
             format=user_config.format,
             language=user_config.language,
@@ -463,6 +688,20 @@ class CalendarConfig:
                 section, "last_errors_count", fallback=0
             ),
             errors_count_threshold=user_config.errors_count_threshold,
+            max_ical_size=user_config.max_ical_size,
+            min_interval=user_config.min_interval,
+            max_interval=user_config.max_interval,
+            events_retention=user_config.events_retention,
+            check_interval=config_parser.getint(
+                section, "check_interval", fallback=user_config.min_interval
+            ),
+            unchanged_checks=config_parser.getint(
+                section, "unchanged_checks", fallback=0
+            ),
+            next_check_at=config_parser.get(section, "next_check_at", fallback=None),
+            events_count=config_parser.getint(section, "events_count", fallback=None),
+            cost=CalendarCost.load(config_parser[section]),
+            persisted=True,
         )
 
     def save(self, exception=None):
@@ -472,34 +711,63 @@ class CalendarConfig:
         :param exception: exception, can be None
         :return: None
         """
-        config_file = CalendarsConfigFile(self.vardir, self.user_id)
-        config_parser = config_file.read_parser()
-        self._create_section(config_parser)
+        with self.storage.locked(self.user_id):
+            config_file = self.storage.calendars_file(self.user_id)
+            config_parser = config_file.read_parser()
+            if not self._create_section(config_parser):
+                return
 
-        config_parser.set(self.id, "url", self.url)
-        config_parser.set(self.id, "name", self.name)
-        config_parser.set(self.id, "channel_id", self.channel_id)
-        config_parser.set(self.id, "verified", str(self.verified))
-        config_parser.set(self.id, "enabled", str(self.enabled))
+            config_parser.set(self.id, "url", self.url)
+            config_parser.set(self.id, "name", self.name)
+            config_parser.set(self.id, "channel_id", self.channel_id)
+            config_parser.set(self.id, "verified", str(self.verified))
+            self._set_enabled(config_parser)
 
-        self._update_last_process(config_parser, exception)
-        config_file.write(config_parser)
+            self._update_last_process(config_parser, exception)
+            config_file.write(config_parser)
+
+    @property
+    def events(self):
+        """
+        Dictionary of known configured events, loaded from the events.cfg file on first access
+        """
+        if self._events is None:
+            self.load_events()
+        return self._events
+
+    @property
+    def events_count(self):
+        """
+        Number of the notified events.
+        Doesn't load the events if they are not loaded yet and the number was persisted,
+        the notifications made after the last save_events() are not counted then.
+        """
+        if self._events is None and self._events_count is not None:
+            return self._events_count
+        return len([event for event in self.events.values() if type(event.last_notified) is int])
 
     def load_events(self):
         """
         Loads the calendar events from the events.cfg file.
         :return: None
         """
-        config_parser = EventsConfigFile(
-            self.vardir, self.user_id, self.id
-        ).read_parser()
+        if self._events is None:
+            self._events = {}
+        config_parser = self.storage.events_file(self.user_id, self.id).read_parser()
 
         for event_id in config_parser.sections():
-            event = EventConfig(self, event_id)
-            event.last_notified = config_parser.getint(
-                event_id, "last_notified", fallback=None
-            )
-            self.events[event_id] = event
+            self.event(event_id).load(config_parser[event_id])
+
+        ledger = self.storage.events_ledger(self.user_id, self.id)
+        for event_id, options in ledger.read():
+            self.event(event_id).load(options)
+
+    def load_feed(self):
+        """
+        Loads the state of the last downloaded ical file from the feed.cfg file.
+        :return: FeedConfig instance
+        """
+        return FeedConfig.load(self)
 
     def event(self, id):
         """
@@ -510,8 +778,8 @@ class CalendarConfig:
         try:
             return self.events[id]
         except KeyError:
-            event = EventConfig(self, id)
-            self.events[id] = event
+            event = EventConfig(sys.intern(id))
+            self.events[event.id] = event
             return event
 
     def event_notified(self, event):
@@ -522,7 +790,44 @@ class CalendarConfig:
         :return: None
         """
         config_event = self.event(event.id)
+        if config_event.last_notified is None:
+            self.stats.events_notified(1)
         config_event.last_notified = event.notified_for_advance
+        config_event.notify_datetime = event.notify_datetime
+        config_event.end = event.end
+
+    def save_event_notified(self, event):
+        """
+        Marks the event in config as notified and appends the notification to the events ledger,
+        it's durable without rewriting all tracked events.
+        The ledger is merged into the events file by save_events().
+        :param event: runtime event processed by ical module
+        :return: None
+        """
+        self.event_notified(event)
+        self.storage.events_ledger(self.user_id, self.id).append(
+            event.id, self.event(event.id).options()
+        )
+
+    def compact_events(self, expired_before=None, keep=()):
+        """
+        Drops the notified events expired long ago,
+        saves all tracked events if some events were dropped or there are notifications in the events ledger.
+        :param expired_before: aware datetime, the events which ended before it are dropped, None to keep all
+        :param keep: IDs of the events to keep anyway, e.g. the events just read from the calendar
+        :return: number of dropped events
+        """
+        dropped = 0
+        if expired_before is not None:
+            keep = set(keep)
+            for event_id, event in list(self.events.items()):
+                if event_id not in keep and event.expired(expired_before):
+                    del self.events[event_id]
+                    dropped += 1
+            self.stats.events_notified(-dropped)
+        if dropped or not self.storage.events_ledger(self.user_id, self.id).is_empty():
+            self.save_events()
+        return dropped
 
     def save_calendar(self, calendar):
         """
@@ -530,36 +835,103 @@ class CalendarConfig:
         :param calendar: Calendar read from ical file
         :return: None
         """
-        config_file = CalendarsConfigFile(self.vardir, self.user_id)
-        config_parser = config_file.read_parser()
+        with self.storage.locked(self.user_id):
+            config_file = self.storage.calendars_file(self.user_id)
+            config_parser = config_file.read_parser()
 
-        self._create_section(config_parser)
+            if not self._create_section(config_parser):
+                return
 
-        self.verified = True
-        config_parser.set(self.id, "verified", "true")
-        self.name = calendar.name
-        config_parser.set(self.id, "name", calendar.name)
+            self.verified = True
+            config_parser.set(self.id, "verified", "true")
+            self.name = calendar.name
+            config_parser.set(self.id, "name", calendar.name)
 
-        self._update_last_process(config_parser)
+            self._update_last_process(config_parser)
 
-        config_file.write(config_parser)
+            config_file.write(config_parser)
 
     def save_events(self):
         """
-        Saves all tracked events into persisted file
+        Saves all notified events into persisted file, clears the events ledger,
+        saves the number of the events and clears the last error
         :return: None
         """
-        config_file = EventsConfigFile(self.vardir, self.user_id, self.id)
+        config_file = self.storage.events_file(self.user_id, self.id)
         config_parser = ConfigParser(interpolation=None)
 
         for event in self.events.values():
-            config_parser.add_section(event.id)
             if type(event.last_notified) is int:
-                config_parser.set(event.id, "last_notified", str(event.last_notified))
+                config_parser.read_dict({event.id: event.options()})
 
         config_file.write(config_parser)
+        self.storage.events_ledger(self.user_id, self.id).clear()
+
+        self._events_count = len(config_parser.sections())
+        with self.storage.locked(self.user_id):
+            config_file = self.storage.calendars_file(self.user_id)
+            config_parser = config_file.read_parser()
+            if not self._create_section(config_parser):
+                return
+            config_parser.set(self.id, "events_count", str(self._events_count))
+            self._update_last_process(config_parser)
+            config_file.write(config_parser)
+
+    def check_due(self, moment):
+        """
+        Checks whether the calendar should be read.
+        :param moment: naive UTC datetime, the calendar is due if it should be read before it
+        :return: True if the calendar should be read
+        """
+        return check_due(self.next_check_at, moment)
+
+    def save_check(self, changed):
+        """
+        Adapts the interval to read the calendar and saves the moment of the next read.
+        The interval is shortened when the ical file changes
+        and lengthened when the file is read unchanged several times in a row.
+        :param changed: True if the ical file content changed since the previous read,
+            False if not, None if it's unknown, e.g. the read failed
+        :return: None
+        """
+        if changed:
+            self.check_interval = max(self.check_interval // 2, self.min_interval)
+            self.unchanged_checks = 0
+        elif changed is not None:
+            self.unchanged_checks += 1
+            if self.unchanged_checks >= UNCHANGED_CHECKS_TO_SLOW_DOWN:
+                self.check_interval = min(self.check_interval * 2, self.max_interval)
+                self.unchanged_checks = 0
+        self.next_check_at = (
+            datetime.utcnow() + timedelta(seconds=self.check_interval)
+        ).isoformat()
+
+        with self.storage.locked(self.user_id):
+            config_file = self.storage.calendars_file(self.user_id)
+            config_parser = config_file.read_parser()
+            if not self._create_section(config_parser):
+                return
+            config_parser.set(self.id, "check_interval", str(self.check_interval))
+            config_parser.set(self.id, "unchanged_checks", str(self.unchanged_checks))
+            config_parser.set(self.id, "next_check_at", self.next_check_at)
+            config_file.write(config_parser)
+
+    def save_cost(self, **values):
+        """
+        Saves the cost of the last read of the calendar and updates its moving averages
+        :param values: the values of the read, by the names of CalendarCost.NAMES
+        :return: None
+        """
+        self.cost.update(**values)
 
-        self.save_error(None)
+        with self.storage.locked(self.user_id):
+            config_file = self.storage.calendars_file(self.user_id)
+            config_parser = config_file.read_parser()
+            if not self._create_section(config_parser):
+                return
+            for name, value in self.cost.options().items():
+                config_parser.set(self.id, name, value)
+            config_file.write(config_parser)
 
     def save_error(self, exception):
         """
@@ -567,21 +939,47 @@ class CalendarConfig:
         :param exception: exception, can be None
         :return: None
         """
-        config_file = CalendarsConfigFile(self.vardir, self.user_id)
-        config_parser = config_file.read_parser()
-        self._create_section(config_parser)
-        self._update_last_process(config_parser, exception)
-        config_file.write(config_parser)
+        with self.storage.locked(self.user_id):
+            config_file = self.storage.calendars_file(self.user_id)
+            config_parser = config_file.read_parser()
+            if not self._create_section(config_parser):
+                return
+            self._update_last_process(config_parser, exception)
+            config_file.write(config_parser)
 
     def _create_section(self, config_parser):
+        """
+        Creates the section of the new calendar.
+        The section of the calendar deleted since it was persisted is not recreated.
+        :param config_parser: ConfigParser of calendars.cfg file
+        :return: True if the section exists, False if the calendar was deleted
+        """
         if not config_parser.has_section(self.id):
+            if self.persisted:
+                logger.info("Calendar %s/%s was deleted, skipping the save", self.user_id, self.id)
+                return False
+            first = not _has_calendars(config_parser)
             config_parser.add_section(self.id)
             config_parser.set(self.id, "url", self.url)
             config_parser.set(self.id, "channel_id", self.channel_id)
+            if not self.enabled:
+                config_parser.set(self.id, "enabled", str(self.enabled))
+            self.stats.calendar_added(self.enabled, first)
+            self.persisted = True
+        return True
+
+    def _set_enabled(self, config_parser):
+        previous = config_parser.getboolean(self.id, "enabled", fallback=True)
+        config_parser.set(self.id, "enabled", str(self.enabled))
+        if self.enabled != previous:
+            self.stats.calendar_enabled(
+                self.enabled, config_parser.getint(self.id, "events_count", fallback=0)
+            )
 
     def _update_last_process(self, config_parser, error=None):
         self.last_process_at = datetime.utcnow().isoformat()
         config_parser.set(self.id, "last_process_at", self.last_process_at)
+        self.stats.processed(self.last_process_at)
         self.last_process_error = error
         config_parser.set(self.id, "last_process_error", str(self.last_process_error))
         if error is None:
@@ -598,23 +996,643 @@ class CalendarConfig:
                     self.last_errors_count,
                 )
                 self.enabled = False
-                config_parser.set(self.id, "enabled", str(self.enabled))
+                self._set_enabled(config_parser)
 
 
 class EventConfig:
     """
-    Current calendar event state.
+    Current calendar event state, kept in the events dict of the calendar.
     """
 
-    def __init__(self, calendar, id):
+    __slots__ = ("id", "last_notified", "notify_datetime", "end")
+
+    def __init__(self, id):
         self.id = id
         """the event id, as it was read from the ical file"""
-        self.cal_id = calendar.id
-        """ID of the calendar to which this event belongs to"""
-        self.user_id = calendar.user_id
-        """Chat ID of the user to whom the calendar belongs to"""
         self.last_notified = None
         """the last notification made for this event, as hours in advance, the integer or None"""
+        self.notify_datetime = None
+        """the event datetime the notification was made for, aware datetime or None"""
+        self.end = None
+        """the moment the event ends, aware datetime or None"""
+
+    def load(self, options):
+        """
+        Loads the event state
+        :param options: dict-like of the persisted options
+        :return: None
+        """
+        if options.get("last_notified") is not None:
+            self.last_notified = int(options["last_notified"])
+        if options.get("notify_datetime") is not None:
+            self.notify_datetime = datetime.fromisoformat(options["notify_datetime"])
+        if options.get("end") is not None:
+            self.end = datetime.fromisoformat(options["end"])
+
+    def options(self):
+        """
+        Converts the event state to be persisted
+        :return: dict of the options as strings
+        """
+        options = {"last_notified": str(self.last_notified)}
+        if self.notify_datetime is not None:
+            options["notify_datetime"] = self.notify_datetime.isoformat()
+        if self.end is not None:
+            options["end"] = self.end.isoformat()
+        return options
+
+    def expired(self, moment):
+        """
+        Checks whether the event happened before the moment, so it can't be notified again.
+        The events persisted without the datetime expire by the datetime of their id,
+        the events without any datetime never expire.
+        :param moment: aware datetime
+        :return: True if the event is expired
+        """
+        notify_datetime = self.notify_datetime or _event_id_datetime(self.id)
+        if notify_datetime is None:
+            return False
+        return max(notify_datetime, self.end or notify_datetime) < moment
+
+
+def _event_id_datetime(event_id):
+    """
+    Parses the event datetime from the event id made as `<uid>_<isoformat>`
+    :param event_id: ID of the event
+    :return: aware datetime or None if the id has no such suffix
+    """
+    _, separator, suffix = event_id.rpartition("_")
+    if not separator:
+        return None
+    try:
+        moment = datetime.fromisoformat(suffix)
+    except ValueError:
+        return None
+    return moment if moment.tzinfo is not None else None
+
+
+class CalendarCost:
+    """
+    Cost of the processing of the calendar:
+    the values of the last read and their exponentially weighted moving averages.
+    """
+
+    __slots__ = ("last", "average")
+
+    NAMES = ("fetch_bytes", "parse_time", "instances", "sends")
+    """downloaded bytes, seconds to parse and expand, number of the expanded events, number of the notifications"""
+
+    def __init__(self, last=None, average=None):
+        self.last = last or {}
+        """the values of the last read, by name"""
+        self.average = average or {}
+        """the moving averages of the values, by name"""
+
+    @classmethod
+    def load(cls, options):
+        """
+        Loads the cost of the calendar
+        :param options: dict-like of the persisted options of the calendar
+        :return: CalendarCost instance
+        """
+        last = {}
+        average = {}
+        for name in cls.NAMES:
+            if options.get(name) is not None:
+                last[name] = float(options[name])
+            if options.get(name + "_avg") is not None:
+                average[name] = float(options[name + "_avg"])
+        return cls(last, average)
+
+    def update(self, **values):
+        """
+        Records the values of the read, the first value starts the average
+        :param values: the values, by name
+        :return: None
+        """
+        for name, value in values.items():
+            self.last[name] = value
+            previous = self.average.get(name)
+            if previous is None:
+                self.average[name] = value
+            else:
+                self.average[name] = previous + COST_SMOOTHING * (value - previous)
+
+    def options(self):
+        """
+        Converts the cost to be persisted
+        :return: dict of the options as strings
+        """
+        options = {name: str(round(value, 6)) for name, value in self.last.items()}
+        options.update((name + "_avg", str(round(value, 6))) for name, value in self.average.items())
+        return options
+
+
+class FeedConfig:
+    """
+    State of the last downloaded ical file of the calendar.
+    """
+
+    def __init__(self, calendar, **kwargs):
+        self.vardir = calendar.vardir
+        """Base var directory"""
+        self.config_file = FeedConfigFile(calendar.vardir, calendar.user_id, calendar.id)
+        """feed.cfg file of the calendar"""
+        self.ical_path = self.config_file.ical_path
+        """path to the last downloaded ical file"""
+        self.url = calendar.url
+        """Url of the ical file"""
+        self.etag = kwargs.get("etag")
+        """ETag header of the last downloaded file"""
+        self.last_modified = kwargs.get("last_modified")
+        """Last-Modified header of the last downloaded file"""
+        self.hash = kwargs.get("hash")
+        """SHA-256 hex digest of the last downloaded file content"""
+
+    @classmethod
+    def load(cls, calendar):
+        """
+        Loads the feed state from the feed.cfg file.
+        The state saved for another url of the calendar is ignored.
+        :param calendar: CalendarConfig instance
+        :return: FeedConfig instance
+        """
+        config_file = FeedConfigFile(calendar.vardir, calendar.user_id, calendar.id)
+        config_parser = config_file.read_parser()
+        if config_parser.get("feed", "url", fallback=None) != calendar.url:
+            return cls(calendar)
+        if not config_parser.has_option("feed", "hash"):
+            return cls(calendar)
+        return cls(
+            calendar,
+            etag=config_parser.get("feed", "etag", fallback=None),
+            last_modified=config_parser.get("feed", "last_modified", fallback=None),
+            hash=config_parser.get("feed", "hash"),
+        )
+
+    def create_ical(self):
+        """
+        Creates the temporary file to download the ical file into.
+        :return: binary file object, it's saved by save() or removed by discard()
+        """
+        os.makedirs(os.path.dirname(self.ical_path), exist_ok=True)
+        return tempfile.NamedTemporaryFile(
+            "wb",
+            dir=os.path.dirname(self.ical_path),
+            prefix="feed.",
+            suffix=".tmp",
+            delete=False,
+        )
+
+    def save(self, file, hash, etag, last_modified):
+        """
+        Replaces the last downloaded ical file with the new one, saves its hash and validators.
+        :param file: the file created by create_ical(), already closed
+        :param hash: SHA-256 hex digest of the file content
+        :param etag: ETag header, can be None
+        :param last_modified: Last-Modified header, can be None
+        :return: None
+        """
+        if (hash, etag, last_modified) == (
+            self.hash,
+            self.etag,
+            self.last_modified,
+        ) and os.path.exists(self.ical_path):
+            self.discard(file)
+            return
+
+        self.hash = hash
+        self.etag = etag
+        self.last_modified = last_modified
+
+        config_parser = ConfigParser(interpolation=None)
+        config_parser.add_section("feed")
+        config_parser.set("feed", "url", self.url)
+        config_parser.set("feed", "hash", hash)
+        if etag is not None:
+            config_parser.set("feed", "etag", etag)
+        if last_modified is not None:
+            config_parser.set("feed", "last_modified", last_modified)
+
+        # the file and its hash are replaced together
+        with Journal(self.vardir) as journal:
+            journal.replace(file.name, self.ical_path)
+            journal.write(self.config_file, config_parser)
+
+    def save_hash(self, hash):
+        """
+        Saves the hash of the ical file downloaded for another calendar with the same url.
+        The own file and validators of the calendar are dropped, they don't match the hash.
+        :param hash: SHA-256 hex digest of the file content
+        :return: None
+        """
+        self.hash = hash
+        self.etag = None
+        self.last_modified = None
+
+        try:
+            os.remove(self.ical_path)
+        except FileNotFoundError:
+            pass
+        config_parser = ConfigParser(interpolation=None)
+        config_parser.add_section("feed")
+        config_parser.set("feed", "url", self.url)
+        config_parser.set("feed", "hash", hash)
+        self.config_file.write(config_parser)
+
+    @staticmethod
+    def discard(file):
+        """
+        Removes the file created by create_ical()
+        :param file: the file, already closed
+        :return: None
+        """
+        try:
+            os.remove(file.name)
+        except FileNotFoundError:
+            pass
+
+
+class FileStorage:
+    """
+    Stores the configs in the files of the var directory.
+    """
+
+    def __init__(self, vardir, write_behind=False, calendars_registry=None):
+        self.vardir = vardir
+        self.calendars = {}
+        """ConfigParsers of calendars.cfg files already read, by user ID"""
+        self.dirty = set()
+        """IDs of users which calendars.cfg files are changed but not written yet"""
+        self.write_behind = write_behind
+        """whether the writes of calendars.cfg files are delayed until flush()"""
+        self.versions = {}
+        """versions of calendars.cfg files the cached ConfigParsers were read from or written to, by user ID"""
+        self.snapshots = {}
+        """options of calendars.cfg files as they were read or written, by user ID"""
+        self.locks = {}
+        """FileLocks by path of the locked file"""
+        self.calendars_registry = calendars_registry or CalendarsRegistry(self)
+        """index of the calendars of all users, shared with the storage of the delayed writes"""
+
+    def user_ids(self):
+        """
+        Lists the users having a directory.
+        :return: list of user IDs
+        """
+        return layout.user_ids(self.vardir)
+
+    def user_file(self, user_id):
+        return UserConfigFile(self.vardir, user_id)
+
+    def calendars_file(self, user_id):
+        return CachedCalendarsFile(self, user_id)
+
+    def registry(self):
+        """
+        Lists the calendars of all users from the index, without reading the users files.
+        :return: list of RegistryEntry
+        """
+        return self.calendars_registry.list()
+
+    def locked(self, user_id):
+        """
+        Locks the files of the user against the other processes,
+        to read, modify and write calendars.cfg or settings.cfg file.
+        The delayed writes are not locked, they are merged into the file on flush().
+        :param user_id: ID of the user
+        :return: context manager
+        """
+        if self.write_behind:
+            return nullcontext()
+        return self.lock(CalendarsConfigFile(self.vardir, user_id).path)
+
+    def lock(self, path):
+        """
+        Returns the lock of the file, reentrant within this storage
+        :param path: path to the locked file
+        :return: FileLock
+        """
+        lock = self.locks.get(path)
+        if lock is None:
+            lock = FileLock(path + ".lock")
+            self.locks[path] = lock
+        return lock
+
+    @contextmanager
+    def delayed_writes(self):
+        """
+        Creates another storage of the same files, which delays the writes of calendars.cfg files
+        until the end of the block, each changed file is written once.
+        The writes through this storage are not delayed and stay locked,
+        the new storage writes through after the block too.
+        The registry of the calendars is shared, it's not loaded again.
+        :return: context manager of the new FileStorage
+        """
+        storage = FileStorage(self.vardir, write_behind=True, calendars_registry=self.calendars_registry)
+        try:
+            yield storage
+        finally:
+            storage.write_behind = False
+            storage.flush()
+
+    def flush(self):
+        """
+        Writes the changed calendars.cfg files.
+        :return: None
+        """
+        for user_id in sorted(self.dirty):
+            if self.store_calendars(user_id):
+                self.calendars_registry.update(user_id, self.calendars[user_id], delayed=True)
+        self.dirty.clear()
+        self.calendars_registry.flush()
+
+    def load_calendars(self, user_id):
+        """
+        Reads calendars.cfg file of the user into the cache
+        :param user_id: ID of the user
+        :return: ConfigParser instance
+        """
+        config_file = CalendarsConfigFile(self.vardir, user_id)
+        self.versions[user_id] = config_file.version()
+        parser = config_file.read_parser()
+        self.calendars[user_id] = parser
+        self.snapshots[user_id] = _snapshot(parser)
+        return parser
+
+    def store_calendars(self, user_id):
+        """
+        Writes the cached calendars.cfg file of the user.
+        If the file was changed by another process since it was read,
+        the changes made by this process are merged into the new file content.
+        :param user_id: ID of the user
+        :return: True if the changes were merged
+        """
+        config_file = CalendarsConfigFile(self.vardir, user_id)
+        with self.lock(config_file.path):
+            parser = self.calendars[user_id]
+            merged = config_file.version() != self.versions.get(user_id)
+            if merged:
+                logger.info("Merging calendars of user %s changed by another process", user_id)
+                changed = parser
+                parser = config_file.read_parser()
+                _merge_parsers(self.snapshots.get(user_id, {}), changed, parser)
+                self.calendars[user_id] = parser
+            config_file.write(parser)
+            self.versions[user_id] = config_file.version()
+            self.snapshots[user_id] = _snapshot(parser)
+        return merged
+
+    def events_file(self, user_id, cal_id):
+        return EventsConfigFile(self.vardir, user_id, cal_id)
+
+    def events_ledger(self, user_id, cal_id):
+        return EventsLedgerFile(self.vardir, user_id, cal_id)
+
+
+class CalendarsRegistry:
+    """
+    Index of the calendars of all users, kept in registry.cfg file.
+    Each calendar is a section named as user_id/cal_id.
+    It's updated on each write of calendars.cfg file
+    and rebuilt from the files if it's missing or the users directories are changed.
+    The registry written by another process is reread, the users updated by this process are kept.
+    """
+
+    VERSION = "1"
+
+    def __init__(self, storage):
+        """
+        Creates the registry, it's loaded on first use
+        :param storage: FileStorage keeping the files
+        """
+        self.storage = storage
+        self.config_file = RegistryConfigFile(storage.vardir)
+        """registry.cfg file"""
+        self.users = None
+        """dict of dicts of RegistryEntry, by user ID and calendar ID"""
+        self.dirty = False
+        """whether the registry is changed but not written yet"""
+        self.version = None
+        """version of registry.cfg file the users were read from or written to"""
+        self.updated = {}
+        """calendars of the users updated since the last write, by user ID"""
+
+    def list(self):
+        """
+        Lists the registered calendars
+        :return: list of RegistryEntry
+        """
+        self.load()
+        return [entry for calendars in self.users.values() for entry in calendars.values()]
+
+    def load(self):
+        """
+        Loads the registry file, rebuilds it if it's missing or stale.
+        :return: None
+        """
+        if self.users is not None:
+            if self.storage.write_behind or self.config_file.version() == self.version:
+                return
+            # written by another process
+            self.version = self.config_file.version()
+            self._read(self.config_file.read_parser())
+            return
+        self.version = self.config_file.version()
+        parser = self.config_file.read_parser()
+        user_ids = set(self.storage.user_ids())
+        if parser.get("registry", "version", fallback=None) == self.VERSION and user_ids == set(
+            parser.get("registry", "users", fallback="").split()
+        ):
+            self._read(parser)
+            return
+
+        logger.info("Rebuilding the registry of %s users", len(user_ids))
+        self.users = {}
+        for user_id in user_ids:
+            self._update(user_id, self.storage.calendars_file(user_id).read_parser())
+        self.write()
+
+    def update(self, user_id, parser, delayed=False):
+        """
+        Updates the calendars of the user.
+        :param user_id: ID of the user
+        :param parser: ConfigParser of calendars.cfg file of the user
+        :param delayed: True to write the registry by flush(), False to write it now
+        :return: None
+        """
+        self.load()
+        if not self._update(user_id, parser):
+            # e.g. only the name or the last error of the calendar is changed
+            return
+        if delayed or self.storage.write_behind:
+            self.dirty = True
+        else:
+            self.write()
+
+    def _read(self, parser):
+        self.users = {user_id: {} for user_id in parser.get("registry", "users", fallback="").split()}
+        for section in parser.sections():
+            if section != "registry":
+                user_id, _, cal_id = section.rpartition("/")
+                self.users.setdefault(user_id, {})[cal_id] = RegistryEntry.from_options(
+                    user_id, cal_id, parser[section]
+                )
+        self.users.update(self.updated)
+
+    def _update(self, user_id, parser):
+        calendars = {
+            cal_id: RegistryEntry.from_options(user_id, cal_id, parser[cal_id])
+            for cal_id in parser.sections()
+            if cal_id != "settings"
+        }
+        previous = self.users.get(user_id)
+        if previous is not None and _registry_options(previous) == _registry_options(calendars):
+            return False
+        self.users[user_id] = calendars
+        self.updated[user_id] = calendars
+        return True
+
+    def flush(self):
+        if self.dirty:
+            self.write()
+
+    def write(self):
+        with self.storage.lock(self.config_file.path):
+            version = self.config_file.version()
+            if version is not None and version != self.version:
+                # written by another process
+                self._read(self.config_file.read_parser())
+            parser = ConfigParser(interpolation=None)
+            parser.read_dict(
+                {"registry": {"version": self.VERSION, "users": " ".join(sorted(self.users))}}
+            )
+            for calendars in self.users.values():
+                for entry in calendars.values():
+                    section = "%s/%s" % (entry.user_id, entry.cal_id)
+                    parser.read_dict({section: {"enabled": str(entry.enabled)}})
+                    if entry.next_check_at is not None:
+                        parser.set(section, "next_check_at", entry.next_check_at)
+            self.config_file.write(parser)
+            self.version = self.config_file.version()
+        self.updated = {}
+        self.dirty = False
+
+
+class StatsCounters:
+    """
+    Statistics counters kept in stats.cfg file.
+    The changes of the counters are accumulated in memory and added to the file by flush(),
+    so several processes can count together.
+    The counters are periodically recalculated from all calendars by calbot.stats.update_stats.
+    The least recent processing moment is updated only by the recalculation.
+    """
+
+    COUNTERS = ("users", "calendars", "disabled_calendars", "events")
+
+    def __init__(self, vardir):
+        """
+        Creates the counters
+        :param vardir: basic var dir
+        """
+        self.config_file = StatsConfigFile(vardir)
+        """stats.cfg file"""
+        self.lock = FileLock(self.config_file.path + ".lock")
+        """lock of stats.cfg file"""
+        self.deltas = dict.fromkeys(self.COUNTERS, 0)
+        """changes of the counters not added to the file yet"""
+        self.last_process_max = None
+        """the most recent processing moment not saved to the file yet, ISO string"""
+
+    def calendar_added(self, enabled, first):
+        """
+        Counts the new calendar.
+        :param enabled: whether the calendar is enabled
+        :param first: whether it's the first calendar of the user
+        """
+        self._add(users=int(first), **self._calendar(enabled, 0, 1))
+
+    def calendar_deleted(self, enabled, events, last):
+        """
+        Counts the deleted calendar.
+        :param enabled: whether the calendar was enabled
+        :param events: number of the notified events of the calendar
+        :param last: whether it was the last calendar of the user
+        """
+        self._add(users=-int(last), **self._calendar(enabled, events, -1))
+
+    def calendar_enabled(self, enabled, events):
+        """
+        Counts the calendar enabled or disabled.
+        :param enabled: whether the calendar is enabled now
+        :param events: number of the notified events of the calendar
+        """
+        self._add(**self._calendar(enabled, events, 1))
+        self._add(**self._calendar(not enabled, events, -1))
+
+    def events_notified(self, count):
+        """
+        Counts the events notified for the first time, or dropped if the count is negative.
+        """
+        self._add(events=count)
+
+    def processed(self, moment):
+        """
+        Saves the moment the calendar was processed.
+        :param moment: ISO string of naive UTC datetime
+        """
+        self.last_process_max = max(moment, self.last_process_max or moment)
+
+    @staticmethod
+    def _calendar(enabled, events, sign):
+        if enabled:
+            return {"calendars": sign, "events": sign * events}
+        return {"disabled_calendars": sign}
+
+    def _add(self, **deltas):
+        for name, delta in deltas.items():
+            self.deltas[name] += delta
+
+    def read(self):
+        """
+        Reads the counters, including the changes not flushed yet.
+        :return: dict of the counters and last_process_min, last_process_max, reconciled_at ISO strings
+        """
+        parser = self.config_file.read_parser()
+        values = {name: parser.getint("stats", name, fallback=0) + self.deltas[name] for name in self.COUNTERS}
+        for name in ("last_process_min", "last_process_max", "reconciled_at"):
+            values[name] = parser.get("stats", name, fallback=None)
+        if self.last_process_max is not None:
+            values["last_process_max"] = max(self.last_process_max, values["last_process_max"] or "")
+        return values
+
+    def flush(self):
+        """
+        Adds the changes of the counters to stats.cfg file.
+        :return: None
+        """
+        if not any(self.deltas.values()) and self.last_process_max is None:
+            return
+        with self.lock:
+            self._write(self.read())
+
+    def reset(self, values):
+        """
+        Replaces the counters with the recalculated ones, the changes not flushed yet are dropped.
+        :param values: dict of the counters and last_process_min, last_process_max ISO strings
+        :return: None
+        """
+        with self.lock:
+            self.deltas = dict.fromkeys(self.COUNTERS, 0)
+            self.last_process_max = None
+            self._write(dict(values, reconciled_at=datetime.utcnow().isoformat()))
+
+    def _write(self, values):
+        parser = ConfigParser(interpolation=None)
+        parser.read_dict({"stats": {name: str(value) for name, value in values.items() if value is not None}})
+        self.config_file.write(parser)
+        self.deltas = dict.fromkeys(self.COUNTERS, 0)
+        self.last_process_max = None
 
 
 class ConfigFile:
@@ -646,15 +1664,302 @@ class ConfigFile:
         self.read(parser)
         return parser
 
+    def version(self):
+        """
+        Identifies the content of the file, it changes on each write as the file is replaced.
+        :return: tuple of the inode, modification time and size, None if the file doesn't exist
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
     def write(self, parser):
         """
-        Writes the configuration to the file. Creates dirs and files if necessary
+        Writes the configuration to the file. Creates dirs and files if necessary.
+        The file is replaced atomically, it's never left partially written.
         :param parser: ConfigParser to be written
         :return: None
         """
-        os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        with open(self.path, "wt", encoding="UTF-8") as file:
-            parser.write(file)
+        os.replace(self.write_temp(parser), self.path)
+
+    def write_temp(self, parser):
+        """
+        Writes the configuration to the temporary file next to the file, synced to the disk.
+        :param parser: ConfigParser to be written
+        :return: path to the temporary file, to replace the file
+        """
+        directory, name = os.path.split(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wt", encoding="UTF-8") as file:
+                parser.write(file)
+                file.flush()
+                os.fsync(file.fileno())
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path
+
+
+class FileLock:
+    """
+    Advisory lock of the file, shared by the processes.
+    It's reentrant: the nested blocks of the same lock don't lock again.
+    """
+
+    def __init__(self, path):
+        """
+        Creates the lock
+        :param path: path to the lock file, it's created if necessary
+        """
+        self.path = path
+        self.file = None
+        """the open lock file while the lock is held"""
+        self.depth = 0
+        """depth of the nested blocks"""
+
+    def __enter__(self):
+        if self.depth == 0:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "a")
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            # closing the file releases the lock
+            self.file.close()
+            self.file = None
+
+
+def _has_calendars(parser):
+    return any(section != "settings" for section in parser.sections())
+
+
+def _snapshot(parser):
+    return {section: dict(parser[section]) for section in parser.sections()}
+
+
+def _registry_options(calendars):
+    return {cal_id: (entry.enabled, entry.next_check_at) for cal_id, entry in calendars.items()}
+
+
+def _merge_parsers(base, changed, parser):
+    """
+    Applies the changes made to the config to its newer version.
+    The sections deleted in the newer version are not restored by the changed options.
+    :param base: dict of the sections options, as the changed config was read
+    :param changed: ConfigParser with the changes
+    :param parser: ConfigParser of the newer version, it's updated
+    :return: None
+    """
+    for section in changed.sections():
+        options = dict(changed[section])
+        original = base.get(section)
+        if original is None:
+            if not parser.has_section(section):
+                parser.add_section(section)
+        elif not parser.has_section(section):
+            continue
+        else:
+            for name in original:
+                if name not in options:
+                    parser.remove_option(section, name)
+            options = {name: value for name, value in options.items() if original.get(name) != value}
+        for name, value in options.items():
+            parser.set(section, name, value)
+    for section in base:
+        if not changed.has_section(section):
+            parser.remove_section(section)
+
+
+class Journal:
+    """
+    Replaces several files together.
+    The new files are written to the temporary files first,
+    then the list of replacements is saved to the journal file in var/journal directory,
+    then the files are replaced and the journal is removed.
+    If the process is killed while replacing, the replacements are completed by recover() at the next start.
+    The journals are committed and recovered under the lock of the journal directory.
+    """
+
+    def __init__(self, vardir):
+        """
+        Creates the journal
+        :param vardir: basic var dir
+        """
+        self.directory = os.path.join(vardir, "journal")
+        """directory of the journal files"""
+        self.replacements = []
+        """list of the (source, target) paths to replace"""
+        self.lock = FileLock(self.directory + ".lock")
+        """lock of the journal directory"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def write(self, config_file, parser):
+        """
+        Writes the configuration to be replaced on commit
+        :param config_file: ConfigFile to write
+        :param parser: ConfigParser to be written
+        :return: None
+        """
+        self.replace(config_file.write_temp(parser), config_file.path)
+
+    def replace(self, source, target):
+        """
+        Adds the file to be replaced on commit
+        :param source: path to the new file, it's moved to the target
+        :param target: path to the file to be replaced
+        :return: None
+        """
+        self.replacements.append((os.path.abspath(source), os.path.abspath(target)))
+
+    def commit(self):
+        """
+        Saves the journal and replaces all files.
+        :return: None
+        """
+        with self.lock:
+            journal_file = JournalFile(self.directory)
+            journal_file.write(self.replacements)
+            self._replace(self.replacements)
+            journal_file.remove()
+        self.replacements = []
+
+    def rollback(self):
+        """
+        Removes the new files.
+        :return: None
+        """
+        for source, _ in self.replacements:
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+        self.replacements = []
+
+    @classmethod
+    def recover(cls, vardir):
+        """
+        Completes the replacements of the journals left by the killed process.
+        Should be called once at the start of the bot.
+        :param vardir: basic var dir
+        :return: number of recovered journals
+        """
+        journal = cls(vardir)
+        if not os.path.isdir(journal.directory):
+            return 0
+        recovered = 0
+        with journal.lock:
+            for name in sorted(os.listdir(journal.directory)):
+                if not name.endswith(".json"):
+                    continue
+                journal_file = JournalFile(journal.directory, name)
+                logger.warning("Recovering journal %s", journal_file.path)
+                cls._replace(journal_file.read())
+                journal_file.remove()
+                recovered += 1
+        return recovered
+
+    @staticmethod
+    def _replace(replacements):
+        for source, target in replacements:
+            if os.path.exists(source):
+                os.replace(source, target)
+
+
+class JournalFile:
+    """
+    Saves the list of replacements of the journal as JSON file.
+    """
+
+    def __init__(self, directory, name=None):
+        """
+        Creates the journal file
+        :param directory: directory of the journal files
+        :param name: name of the existing file, None to create a new one
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, name) if name is not None else None
+
+    def write(self, replacements):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wt", encoding="UTF-8") as file:
+            json.dump(replacements, file)
+            file.flush()
+            os.fsync(file.fileno())
+        # the journal is valid only when it's completely written
+        self.path = temp_path[: -len(".tmp")] + ".json"
+        os.replace(temp_path, self.path)
+
+    def read(self):
+        with open(self.path, "rt", encoding="UTF-8") as file:
+            return json.load(file)
+
+    def remove(self):
+        os.remove(self.path)
+
+
+class CachedCalendarsFile:
+    """
+    Reads calendars config file once and keeps it in memory,
+    the writes can be delayed by FileStorage.delayed_writes().
+    """
+
+    def __init__(self, storage, user_id):
+        """
+        Creates the config
+        :param storage: FileStorage keeping the files
+        :param user_id: user ID as string
+        """
+        self.storage = storage
+        self.user_id = user_id
+
+    def read_parser(self):
+        """
+        Returns the ConfigParser of the file, it's shared by all readers of the file
+        :return: ConfigParser instance
+        """
+        parser = self.storage.calendars.get(self.user_id)
+        if parser is not None and not self.storage.write_behind:
+            # the file could be changed by another process
+            if CalendarsConfigFile(self.storage.vardir, self.user_id).version() != self.storage.versions.get(
+                self.user_id
+            ):
+                parser = None
+        if parser is None:
+            parser = self.storage.load_calendars(self.user_id)
+        return parser
+
+    def write(self, parser):
+        """
+        Writes the configuration to the file, or marks it to be written later
+        :param parser: ConfigParser to be written
+        :return: None
+        """
+        self.storage.calendars[self.user_id] = parser
+        if self.storage.write_behind:
+            self.storage.dirty.add(self.user_id)
+        else:
+            self.storage.store_calendars(self.user_id)
+            self.storage.dirty.discard(self.user_id)
+            parser = self.storage.calendars[self.user_id]
+        self.storage.calendars_registry.update(self.user_id, parser, delayed=self.storage.write_behind)
 
 
 class UserConfigFile(ConfigFile):
@@ -668,7 +1973,7 @@ class UserConfigFile(ConfigFile):
         :param vardir: basic var dir
         :param user_id: user ID as string
         """
-        super().__init__(os.path.join(vardir, user_id, "settings.cfg"))
+        super().__init__(os.path.join(layout.user_dir(vardir, user_id), "settings.cfg"))
 
 
 class CalendarsConfigFile(ConfigFile):
@@ -682,7 +1987,7 @@ class CalendarsConfigFile(ConfigFile):
         :param vardir: basic var dir
         :param user_id: user ID as string
         """
-        super().__init__(os.path.join(vardir, user_id, "calendars.cfg"))
+        super().__init__(os.path.join(layout.user_dir(vardir, user_id), "calendars.cfg"))
 
 
 class EventsConfigFile(ConfigFile):
@@ -697,4 +2002,107 @@ class EventsConfigFile(ConfigFile):
         :param user_id: user ID as string
         :param cal_id: ID of the calendar
         """
-        super().__init__(os.path.join(vardir, user_id, cal_id, "events.cfg"))
+        super().__init__(os.path.join(layout.user_dir(vardir, user_id), cal_id, "events.cfg"))
+
+
+class RegistryConfigFile(ConfigFile):
+    """
+    Reads and writes the registry of calendars.
+    """
+
+    def __init__(self, vardir):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        """
+        super().__init__(os.path.join(vardir, "registry.cfg"))
+
+
+class StatsConfigFile(ConfigFile):
+    """
+    Reads and writes stats config file.
+    """
+
+    def __init__(self, vardir):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        """
+        super().__init__(os.path.join(vardir, "stats.cfg"))
+
+
+class EventsLedgerFile:
+    """
+    Appends the notifications of the calendar events to the events ledger file.
+    """
+
+    def __init__(self, vardir, user_id, cal_id):
+        """
+        Creates the ledger
+        :param vardir: basic var dir
+        :param user_id: user ID as string
+        :param cal_id: ID of the calendar
+        """
+        self.path = os.path.join(layout.user_dir(vardir, user_id), cal_id, "events.log")
+
+    def append(self, event_id, options):
+        """
+        Appends the notification as JSON line, the file is synced to the disk.
+        :param event_id: ID of the event
+        :param options: dict of the event options as strings
+        :return: None
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "at", encoding="UTF-8") as file:
+            file.write(json.dumps([event_id, options]) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def read(self):
+        """
+        Reads the notifications, the incomplete last line is ignored.
+        :return: it's generator, yields event ID and dict of the event options
+        """
+        try:
+            with open(self.path, "rt", encoding="UTF-8") as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        break
+                    try:
+                        event_id, options = json.loads(line)
+                    except ValueError:
+                        logger.warning("Invalid line in %s: %s", self.path, line)
+                        continue
+                    yield event_id, options
+        except FileNotFoundError:
+            return
+
+    def is_empty(self):
+        try:
+            return os.path.getsize(self.path) == 0
+        except FileNotFoundError:
+            return True
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FeedConfigFile(ConfigFile):
+    """
+    Reads and writes feed config file.
+    """
+
+    def __init__(self, vardir, user_id, cal_id):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        :param user_id: user ID as string
+        :param cal_id: ID of the calendar
+        """
+        calendar_dir = os.path.join(layout.user_dir(vardir, user_id), cal_id)
+        super().__init__(os.path.join(calendar_dir, "feed.cfg"))
+        self.ical_path = os.path.join(calendar_dir, "feed.ics")
+        """path to the saved ical file"""
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+SQLite storage of the users, calendars and events configs.
+
+The configs are still read and written as ConfigParser objects, as from the files,
+but each section is a row of the table and each option is a column.
+
+```
+users - user_id, options of settings.cfg and last_id of calendars.cfg
+calendars - user_id, cal_id, options of the calendar section of calendars.cfg
+events - user_id, cal_id, event_id, options of the event section of events.cfg
+meta - name, value of the state of the database itself, e.g. whether the files were imported
+```
+
+The columns for new options are added when the options are written first time.
+"""
+
+import logging
+import os
+import sqlite3
+from configparser import ConfigParser
+from contextlib import contextmanager
+
+from calbot.registry import RegistryEntry
+
+__all__ = ["SqliteStorage"]
+
+logger = logging.getLogger("db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    format TEXT,
+    language TEXT,
+    advance TEXT,
+    last_id TEXT
+);
+CREATE TABLE IF NOT EXISTS calendars (
+    user_id TEXT NOT NULL,
+    cal_id TEXT NOT NULL,
+    url TEXT,
+    name TEXT,
+    channel_id TEXT,
+    verified TEXT,
+    enabled TEXT,
+    last_process_at TEXT,
+    last_process_error TEXT,
+    last_errors_count TEXT,
+    PRIMARY KEY (user_id, cal_id)
+);
+CREATE TABLE IF NOT EXISTS events (
+    user_id TEXT NOT NULL,
+    cal_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    last_notified TEXT,
+    PRIMARY KEY (user_id, cal_id, event_id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+USER_OPTIONS = ("format", "language", "advance")
+
+
+class SqliteStorage:
+    """
+    Stores the configs in the SQLite database.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the database, creates the tables if necessary
+        :param path: path to the database file
+        """
+        self.path = path
+        """path to the database file"""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        """the connection to the database"""
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.columns = {}
+        """known columns, by table"""
+        self.depth = 0
+        """depth of the nested transactions"""
+
+    def close(self):
+        self.connection.close()
+
+    @property
+    def imported(self):
+        """
+        Whether the files were completely imported by import_files()
+        """
+        cursor = self.connection.execute("SELECT value FROM meta WHERE name = 'files_imported'")
+        return cursor.fetchone() is not None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups the reads and writes to one transaction, the transactions can be nested.
+        The database is locked for writes by other processes until the outer transaction ends.
+        :return: context manager, commits on exit of the outer one, rolls back on error
+        """
+        if self.depth == 0 and not self.connection.in_transaction:
+            self.connection.execute("BEGIN IMMEDIATE")
+        self.depth += 1
+        try:
+            yield self.connection
+        except BaseException:
+            if self.depth == 1:
+                self.connection.rollback()
+            raise
+        else:
+            if self.depth == 1:
+                self.connection.commit()
+        finally:
+            self.depth -= 1
+
+    def locked(self, user_id):
+        """
+        Reads, modifies and writes the configs of the user in one transaction.
+        :param user_id: ID of the user
+        :return: context manager
+        """
+        return self.transaction()
+
+    @contextmanager
+    def delayed_writes(self):
+        """
+        The writes to the database are cheap and not delayed.
+        :return: context manager of this storage
+        """
+        yield self
+
+    def flush(self):
+        pass
+
+    def user_ids(self):
+        """
+        Lists the users having settings or calendars.
+        :return: list of user IDs
+        """
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT user_id FROM users UNION SELECT user_id FROM calendars ORDER BY 1"
+            )
+        ]
+
+    def registry(self):
+        """
+        Lists the calendars of all users from the calendars table.
+        :return: list of RegistryEntry
+        """
+        return [
+            RegistryEntry.from_options(row["user_id"], row["cal_id"], row)
+            for row in self.select("calendars", "1 ORDER BY user_id, rowid", ())
+        ]
+
+    def user_file(self, user_id):
+        return SqliteUserFile(self, user_id)
+
+    def calendars_file(self, user_id):
+        return SqliteCalendarsFile(self, user_id)
+
+    def events_file(self, user_id, cal_id):
+        return SqliteEventsFile(self, user_id, cal_id)
+
+    def events_ledger(self, user_id, cal_id):
+        return SqliteEventsLedger(self, user_id, cal_id)
+
+    def import_files(self, source):
+        """
+        Copies all configs from another storage, e.g. migrates the files from the var directory.
+        The notifications from the events ledgers are merged into the copied events.
+        The configs are copied in one transaction, which also marks the database as imported,
+        so the failed import leaves nothing and can be run again.
+        :param source: storage to copy from
+        :return: number of copied users
+        """
+        user_ids = source.user_ids()
+        with self.transaction() as connection:
+            for user_id in user_ids:
+                self.user_file(user_id).write(source.user_file(user_id).read_parser())
+                calendars_parser = source.calendars_file(user_id).read_parser()
+                self.calendars_file(user_id).write(calendars_parser)
+                for cal_id in calendars_parser.sections():
+                    if cal_id != "settings":
+                        events_parser = source.events_file(user_id, cal_id).read_parser()
+                        # the notifications not merged into the events file yet
+                        for event_id, options in source.events_ledger(user_id, cal_id).read():
+                            events_parser.read_dict({event_id: options})
+                        self.events_file(user_id, cal_id).write(events_parser)
+            connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('files_imported', '1')")
+        logger.info("Imported %s users into %s", len(user_ids), self.path)
+        return len(user_ids)
+
+    def select(self, table, where, params):
+        """
+        Selects the rows as dicts of not NULL values.
+        """
+        cursor = self.connection.execute(
+            "SELECT * FROM %s WHERE %s" % (table, where), params
+        )
+        names = [description[0] for description in cursor.description]
+        for row in cursor:
+            yield {name: value for name, value in zip(names, row) if value is not None}
+
+    def insert(self, table, rows):
+        """
+        Inserts the rows, the rows with the same columns are inserted in one batch.
+        :param table: name of the table
+        :param rows: list of dicts of column values
+        """
+        batches = {}
+        for row in rows:
+            batches.setdefault(tuple(row), []).append(row)
+        with self.transaction() as connection:
+            for names, batch in batches.items():
+                self._ensure_columns(table, names)
+                connection.executemany(
+                    "INSERT INTO %s (%s) VALUES (%s)"
+                    % (table, ", ".join('"%s"' % name for name in names), ", ".join("?" * len(names))),
+                    [[row[name] for name in names] for row in batch],
+                )
+
+    def upsert(self, table, keys, rows):
+        """
+        Inserts or updates the rows.
+        :param table: name of the table
+        :param keys: tuple of the primary key columns
+        :param rows: non-empty list of dicts of column values, all dicts have the same columns
+        """
+        names = list(rows[0])
+        self._ensure_columns(table, names)
+        updates = [name for name in names if name not in keys]
+        sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO %s" % (
+            table,
+            ", ".join('"%s"' % name for name in names),
+            ", ".join("?" * len(names)),
+            ", ".join(keys),
+            (
+                "UPDATE SET " + ", ".join('"%s" = excluded."%s"' % (name, name) for name in updates)
+                if updates
+                else "NOTHING"
+            ),
+        )
+        with self.transaction() as connection:
+            connection.executemany(sql, [[row[name] for name in names] for row in rows])
+
+    def _ensure_columns(self, table, names):
+        columns = self.columns.get(table)
+        if columns is None:
+            columns = set(row[1] for row in self.connection.execute("PRAGMA table_info(%s)" % table))
+            self.columns[table] = columns
+        for name in names:
+            if name not in columns:
+                if not name.isidentifier():
+                    raise ValueError("Invalid option name %s" % name)
+                self.connection.execute('ALTER TABLE %s ADD COLUMN "%s" TEXT' % (table, name))
+                columns.add(name)
+
+
+class SqliteConfigFile:
+    """
+    Reads and writes the rows of the table as a config file.
+    The subclasses implement read(parser) and write(parser) for their tables.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def read_parser(self):
+        """
+        Creates the new ConfigParser and read values from the database to it
+        :return: ConfigParser instance
+        """
+        parser = ConfigParser(interpolation=None)
+        self.read(parser)
+        return parser
+
+
+class SqliteUserFile(SqliteConfigFile):
+    """
+    Reads and writes user settings as settings.cfg file.
+    """
+
+    def __init__(self, storage, user_id):
+        super().__init__(storage)
+        self.user_id = user_id
+
+    def read(self, parser):
+        for row in self.storage.select("users", "user_id = ?", (self.user_id,)):
+            options = {name: row[name] for name in USER_OPTIONS if name in row}
+            if options:
+                parser.read_dict({"settings": options})
+
+    def write(self, parser):
+        row = {"user_id": self.user_id}
+        for name in USER_OPTIONS:
+            row[name] = parser.get("settings", name, fallback=None)
+        self.storage.upsert("users", ("user_id",), [row])
+
+
+class SqliteCalendarsFile(SqliteConfigFile):
+    """
+    Reads and writes the user calendars as calendars.cfg file.
+    """
+
+    def __init__(self, storage, user_id):
+        super().__init__(storage)
+        self.user_id = user_id
+
+    def read(self, parser):
+        for row in self.storage.select("users", "user_id = ?", (self.user_id,)):
+            if "last_id" in row:
+                parser.read_dict({"settings": {"last_id": row["last_id"]}})
+        for row in self.storage.select("calendars", "user_id = ? ORDER BY rowid", (self.user_id,)):
+            cal_id = row.pop("cal_id")
+            del row["user_id"]
+            parser.read_dict({cal_id: row})
+
+    def write(self, parser):
+        with self.storage.transaction() as connection:
+            if parser.has_option("settings", "last_id"):
+                self.storage.upsert(
+                    "users",
+                    ("user_id",),
+                    [{"user_id": self.user_id, "last_id": parser.get("settings", "last_id")}],
+                )
+            connection.execute("DELETE FROM calendars WHERE user_id = ?", (self.user_id,))
+            rows = []
+            for cal_id in parser.sections():
+                if cal_id != "settings":
+                    row = {"user_id": self.user_id, "cal_id": cal_id}
+                    row.update(parser.items(cal_id))
+                    rows.append(row)
+            self.storage.insert("calendars", rows)
+
+
+class SqliteEventsFile(SqliteConfigFile):
+    """
+    Reads and writes the calendar events as events.cfg file.
+    """
+
+    def __init__(self, storage, user_id, cal_id):
+        super().__init__(storage)
+        self.user_id = user_id
+        self.cal_id = cal_id
+
+    def read(self, parser):
+        for row in self.storage.select(
+            "events", "user_id = ? AND cal_id = ? ORDER BY rowid", (self.user_id, self.cal_id)
+        ):
+            event_id = row.pop("event_id")
+            del row["user_id"]
+            del row["cal_id"]
+            parser.read_dict({event_id: row})
+
+    def write(self, parser):
+        with self.storage.transaction() as connection:
+            connection.execute(
+                "DELETE FROM events WHERE user_id = ? AND cal_id = ?",
+                (self.user_id, self.cal_id),
+            )
+            rows = []
+            for event_id in parser.sections():
+                row = {"user_id": self.user_id, "cal_id": self.cal_id, "event_id": event_id}
+                row.update(parser.items(event_id))
+                rows.append(row)
+            self.storage.insert("events", rows)
+
+
+class SqliteEventsLedger:
+    """
+    Saves each notification of the calendar event as the row of the events table,
+    so there is nothing to merge later.
+    """
+
+    def __init__(self, storage, user_id, cal_id):
+        self.storage = storage
+        self.user_id = user_id
+        self.cal_id = cal_id
+
+    def append(self, event_id, options):
+        row = {"user_id": self.user_id, "cal_id": self.cal_id, "event_id": event_id}
+        row.update(options)
+        self.storage.upsert("events", ("user_id", "cal_id", "event_id"), [row])
+
+    def read(self):
+        return iter(())
+
+    def is_empty(self):
+        return True
+
+    def clear(self):
+        pass
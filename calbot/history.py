@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+History of the calendars processing cycles, kept in `var/stats.history` file.
+
+The file is a ring buffer of the fixed size records, mapped to the memory:
+the header keeps the capacity and the number of the appended records,
+the oldest records are overwritten when the buffer is full.
+The history of the last day and week can be summarized from the command line:
+
+```
+python -m calbot.history calbot.cfg
+```
+"""
+
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from calbot.conf import FileLock
+
+__all__ = ["Record", "StatsHistory", "percentile"]
+
+HISTORY_FILE = "stats.history"
+
+MAGIC = b"CBSH"
+
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHIQ")
+"""magic, version, record size, capacity, number of the appended records"""
+
+RECORD = struct.Struct("<dfIIII")
+
+DEFAULT_CAPACITY = 8192
+
+SUMMARY_PERIODS = (("24 hours", 24 * 3600), ("7 days", 7 * 24 * 3600))
+
+SUMMARY_FORMAT = """Last {}: {} cycles
+Cycle duration: p50 {:.1f} s, p95 {:.1f} s, max {:.1f} s
+Calendars: {} enabled, {} processed, {} failed
+Notifications sent: {}"""
+
+Record = namedtuple("Record", "time duration calendars processed failed sent")
+"""
+The processing cycle: UNIX time when it ended, its duration in seconds,
+numbers of the enabled, processed and failed calendars,
+number of the notifications sent since the previous cycle.
+"""
+
+
+class StatsHistory:
+    """
+    Ring buffer of the processing cycles records, shared by the processes.
+    """
+
+    def __init__(self, vardir, capacity=DEFAULT_CAPACITY):
+        """
+        Creates the history
+        :param vardir: basic var dir
+        :param capacity: number of the records kept, if the file is created
+        """
+        self.path = os.path.join(vardir, HISTORY_FILE)
+        """path to the history file"""
+        self.capacity = capacity
+        """number of the records kept in the new file, the existing file keeps its capacity"""
+        self.lock = FileLock(self.path + ".lock")
+        """lock of the history file"""
+
+    def append(self, record):
+        """
+        Appends the record, overwrites the oldest one if the buffer is full.
+        :param record: Record
+        :return: None
+        """
+        with self.lock, self._map() as buffer:
+            _, _, _, capacity, count = HEADER.unpack_from(buffer)
+            RECORD.pack_into(buffer, HEADER.size + count % capacity * RECORD.size, *record)
+            HEADER.pack_into(buffer, 0, MAGIC, VERSION, RECORD.size, capacity, count + 1)
+
+    def records(self, since=None):
+        """
+        Reads the kept records.
+        :param since: UNIX time, the older records are skipped, None to read all
+        :return: list of Record, the oldest first
+        """
+        if not os.path.exists(self.path):
+            return []
+        with self.lock, self._map() as buffer:
+            _, _, _, capacity, count = HEADER.unpack_from(buffer)
+            records = [
+                Record._make(RECORD.unpack_from(buffer, HEADER.size + i % capacity * RECORD.size))
+                for i in range(max(count - capacity, 0), count)
+            ]
+        if since is None:
+            return records
+        return [record for record in records if record.time >= since]
+
+    def summary(self, name, seconds):
+        """
+        Summarizes the records of the last period.
+        :param name: name of the period to show
+        :param seconds: length of the period in seconds
+        :return: Summary object
+        """
+        return Summary(name, self.records(time.time() - seconds))
+
+    def summaries(self):
+        """
+        Summarizes the records of the last day and week.
+        :return: text of the summaries
+        """
+        return "\n\n".join(str(self.summary(*period)) for period in SUMMARY_PERIODS)
+
+    @contextmanager
+    def _map(self):
+        """
+        Maps the file to the memory, (re)creates it if it's missing or has another format.
+        """
+        size = HEADER.size + self.capacity * RECORD.size
+        with open(self.path, "r+b" if os.path.exists(self.path) else "w+b") as file:
+            header = file.read(HEADER.size)
+            if len(header) == HEADER.size:
+                magic, version, record_size, capacity, _ = HEADER.unpack(header)
+                size = HEADER.size + capacity * RECORD.size
+            if (
+                len(header) < HEADER.size
+                or (magic, version, record_size) != (MAGIC, VERSION, RECORD.size)
+                or capacity == 0
+                or os.fstat(file.fileno()).st_size != size
+            ):
+                size = HEADER.size + self.capacity * RECORD.size
+                file.truncate(0)
+                file.truncate(size)
+                file.seek(0)
+                file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.capacity, 0))
+                file.flush()
+            with mmap.mmap(file.fileno(), size) as buffer:
+                yield buffer
+
+
+class Summary:
+    """
+    Summary of the processing cycles of the period.
+    """
+
+    def __init__(self, name, records):
+        self.name = name
+        """Name of the period"""
+        self.cycles = len(records)
+        """Number of the processing cycles"""
+        durations = sorted(record.duration for record in records)
+        self.duration_p50 = percentile(durations, 50)
+        """Median duration of the cycle, in seconds"""
+        self.duration_p95 = percentile(durations, 95)
+        """95th percentile of the cycle duration, in seconds"""
+        self.duration_max = durations[-1] if durations else 0.0
+        """Longest duration of the cycle, in seconds"""
+        self.calendars = records[-1].calendars if records else 0
+        """Number of the enabled calendars at the end of the period"""
+        self.processed = sum(record.processed for record in records)
+        """Number of the processed calendars"""
+        self.failed = sum(record.failed for record in records)
+        """Number of the calendars failed to be fetched or processed"""
+        self.sent = sum(record.sent for record in records)
+        """Number of the sent notifications"""
+
+    def __str__(self):
+        return SUMMARY_FORMAT.format(
+            self.name,
+            self.cycles,
+            self.duration_p50,
+            self.duration_p95,
+            self.duration_max,
+            self.calendars,
+            self.processed,
+            self.failed,
+            self.sent,
+        )
+
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile of the sorted values, 0 if there are no values.
+    """
+    if not values:
+        return 0.0
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+def main():
+    from calbot.conf import Config
+
+    if len(sys.argv) < 2:
+        print("Usage: python -m calbot.history calbot.cfg", file=sys.stderr)
+        sys.exit(1)
+    print(StatsHistory(Config(sys.argv[1]).vardir).summaries())
+
+
+if __name__ == "__main__":
+    main()
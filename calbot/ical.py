@@ -18,82 +18,668 @@
 # along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
 
 
+import asyncio
+import copy
+import hashlib
+import io
 import logging
-from datetime import datetime, date, timedelta
+import os
+import re
+import sys
+from collections import OrderedDict
+from datetime import datetime, date, time, timedelta
+from time import perf_counter
+from urllib.parse import urlparse
 from urllib.request import urlopen
+import httpx
 import pytz
 import icalendar
 import recurring_ical_events
+from dateutil.rrule import rrulestr
 
+from calbot import metrics
 from calbot.formatting import BlankFormat
 
-__all__ = ['Calendar', 'sample_event']
+__all__ = ['Calendar', 'CalendarReader', 'read_calendar', 'fetch_ical', 'parse_ical',
+           'iter_ical_components', 'sample_event']
 
 
 logger = logging.getLogger('ical')
 
+FETCH_TIMEOUT = 60
+"""timeout in seconds to download the ical file"""
+
+FETCH_CHUNK_SIZE = 64 * 1024
+"""the ical file is downloaded by chunks of this size"""
+
+
+PARSED_CACHE_SIZE = 64
+"""how many parsed ical files are kept in memory by default, see parsed_cache_size option"""
+
+EXPANDED_CACHE_SIZE = 256
+"""how many expansions of the parsed ical files are kept in memory by default, see expanded_cache_size option"""
+
+
+class LRUCache:
+    """
+    Keeps the limited number of the recently used values.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        """max number of values to keep"""
+        self.values = OrderedDict()
+        """cached values, the recently used values are at the end"""
+        self.hits = 0
+        """how many times the requested value was found"""
+        self.misses = 0
+        """how many times the requested value was not found"""
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key):
+        """
+        Returns the cached value and marks it as recently used.
+        :param key: key of the value
+        :return: the value, None if it's not cached
+        """
+        try:
+            self.values.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.values[key]
+
+    def put(self, key, value):
+        """
+        Caches the value, evicts the least recently used values if the cache is full.
+        :param key: key of the value
+        :param value: the value
+        :return: None
+        """
+        self.values[key] = value
+        self.values.move_to_end(key)
+        while len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+
+PRUNE_MARGIN = timedelta(days=1)
+"""events are pruned outside of the period extended by this margin, it covers time zones of the events"""
+
+MAX_PRUNED_COUNT = 10000
+"""repeating events with greater COUNT are never pruned"""
+
+TZID_PARAM = re.compile(rb';TZID="?([^";:]+)', re.IGNORECASE)
+"""TZID parameter of the property, the time zone the date refers to"""
+
+parsed_calendars = LRUCache(PARSED_CACHE_SIZE)
+"""parsed ical files, by SHA-256 hex digest of the file content and the end day of the parsed period"""
+
+expanded_calendars = LRUCache(EXPANDED_CACHE_SIZE)
+"""Expansion of the parsed ical files, by the key of the parsed file and the day start"""
+
+
+class Expansion:
+    """
+    Events already expanded from the parsed ical file, to expand only the new period on the next read.
+    """
+
+    def __init__(self, until, events):
+        self.until = until
+        """the end of the period the repeating events were expanded for"""
+        self.events = events
+        """list of events expanded until this moment"""
+
+
+class CalendarReader:
+    """
+    Reads each ical file once for all calendars with the same url.
+    The file is read for the calendar with the widest advance,
+    other calendars get their own views of it and keep its hash.
+    """
+
+    def __init__(self, configs, executor=None, lookahead=timedelta()):
+        """
+        Creates the reader
+        :param configs: iterable of CalendarConfig to be read
+        :param executor: concurrent.futures.Executor to parse calendars, None for the default one
+        :param lookahead: timedelta, also read events happening so long after the advance
+        """
+        self.executor = executor
+        """executor to parse calendars"""
+        self.lookahead = lookahead
+        """how long after the advance the events are read"""
+        self.primary_configs = {}
+        """calendar configs to read the ical files for, by url"""
+        self.reads = {}
+        """started reads of the ical files, by url"""
+
+        for config in configs:
+            if not config.enabled:
+                continue
+            primary = self.primary_configs.get(config.url)
+            if primary is None or max(config.advance) > max(primary.advance):
+                self.primary_configs[config.url] = config
+
+    async def read(self, config):
+        """
+        Reads the calendar, the ical file is downloaded and parsed only once for the url.
+        :param config: CalendarConfig
+        :return: Calendar instance
+        """
+        primary = self.primary_configs.setdefault(config.url, config)
+        if config.url not in self.reads:
+            self.reads[config.url] = asyncio.ensure_future(read_calendar(primary, self.executor, self.lookahead))
+        calendar = await self.reads[config.url]
+        if config is primary:
+            return calendar
+        calendar = calendar.for_config(config)
+        # the calendar may be read for itself later, its changes are tracked by its own feed state
+        feed = config.load_feed()
+        calendar.changed = feed.hash != calendar.hash
+        if calendar.changed:
+            feed.save_hash(calendar.hash)
+        return calendar
+
+
+async def read_calendar(config, executor=None, lookahead=timedelta()):
+    """
+    Downloads the ical file without blocking the event loop,
+    then parses it and expands repeating events in the executor.
+    If the downloaded file content is the same as of recently parsed file, the parsed file is reused.
+    :param config: CalendarConfig
+    :param executor: concurrent.futures.Executor to parse the calendar, None for the default one
+    :param lookahead: timedelta, also read events happening so long after the advance
+    :return: Calendar instance
+    """
+    loop = asyncio.get_running_loop()
+    feed = config.load_feed()
+
+    # parse events until the end of the next day to reuse the parsed file during the day
+    after = datetime.now(tz=pytz.UTC)
+    before = datetime.combine(
+        (after + timedelta(hours=max(config.advance)) + lookahead).date() + timedelta(days=1), time(), tzinfo=pytz.UTC)
+
+    previous_hash = feed.hash
+    ical_hash, fetched_bytes = await _fetch_feed(feed, config, feed.etag, feed.last_modified)
+
+    if ical_hash is None and (feed.hash, before) not in parsed_calendars and not os.path.exists(feed.ical_path):
+        # the saved file is lost, download it again
+        _, lost_bytes = await _fetch_feed(feed, config)
+        fetched_bytes += lost_bytes
+
+    started = perf_counter()
+    key = (feed.hash, before)
+    # the same content is not parsed again, even if the server doesn't send validators
+    vcalendar = parsed_calendars.get(key)
+    if vcalendar is None:
+        with metrics.parse_seconds.time():
+            vcalendar = await loop.run_in_executor(
+                executor, _parse_ical_path, feed.ical_path, after, before, config.max_ical_size)
+        parsed_calendars.put(key, vcalendar)
+
+    # the same parsed content is expanded only for the period not expanded yet
+    expanded_key = (key, config.day_start)
+    # only the plain settings go to the executor, the config and its storage stay in the event loop
+    with metrics.expand_seconds.time():
+        calendar = await loop.run_in_executor(
+            executor, _expand_calendar, CalendarSettings(config), vcalendar,
+            expanded_calendars.get(expanded_key), lookahead)
+    expanded_calendars.put(expanded_key, calendar.expansion)
+    calendar.select_events(config)
+    calendar.changed = feed.hash != previous_hash
+    calendar.hash = feed.hash
+    calendar.fetched_bytes = fetched_bytes
+    calendar.parse_time = perf_counter() - started
+    return calendar
+
+
+async def _fetch_feed(feed, config, etag=None, last_modified=None):
+    """
+    Downloads the ical file of the feed, keeps it if it's modified.
+    :return: tuple of SHA-256 hex digest of the file content, None if it's not modified,
+        and the number of the downloaded bytes
+    """
+    file = feed.create_ical()
+    try:
+        with file:
+            result = await fetch_ical(config.url, file, etag, last_modified, config.max_ical_size)
+            size = file.tell()
+        if result[0] is None:
+            feed.discard(file)
+        else:
+            feed.save(file, *result)
+        return result[0], size
+    except BaseException:
+        feed.discard(file)
+        raise
+
+
+async def fetch_ical(url, file, etag=None, last_modified=None, max_size=None):
+    """
+    Downloads the ical file by chunks.
+    Http and https urls are requested asynchronously, conditionally if validators are known,
+    other schemes supported by urlopen are read in a thread.
+    :param url: url to read
+    :param file: binary file object to write the ical file to
+    :param etag: ETag of the previously downloaded file, can be None
+    :param last_modified: Last-Modified of the previously downloaded file, can be None
+    :param max_size: max size of the file in bytes, None for unlimited
+    :return: tuple of SHA-256 hex digest of the file content, None if it's not modified,
+        and its ETag and Last-Modified, can be None
+    """
+    logger.info('Getting %s', url)
+    writer = _IcalWriter(file, max_size)
+    try:
+        with metrics.fetch_seconds.time():
+            return await _fetch_ical(url, writer, etag, last_modified)
+    finally:
+        metrics.fetched_bytes.inc(writer.size)
+
+
+async def _fetch_ical(url, writer, etag, last_modified):
+    if urlparse(url).scheme not in ('http', 'https'):
+        await asyncio.to_thread(_read_url, url, writer)
+        return writer.hash.hexdigest(), None, None
+
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    async with httpx.AsyncClient(follow_redirects=True, timeout=FETCH_TIMEOUT) as client:
+        async with client.stream('GET', url, headers=headers) as response:
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                logger.info('Not modified %s', url)
+                return None, etag, last_modified
+
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(FETCH_CHUNK_SIZE):
+                writer.write(chunk)
+
+    return writer.hash.hexdigest(), response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+class _IcalWriter:
+    """
+    Writes the downloaded ical file, counts its size and hash.
+    """
+
+    def __init__(self, file, max_size):
+        self.file = file
+        self.max_size = max_size
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ValueError(f'The ical file is larger than {self.max_size} bytes')
+        self.hash.update(chunk)
+        self.file.write(chunk)
+
+
+def _read_url(url, writer):
+    with urlopen(url, timeout=FETCH_TIMEOUT) as f:
+        for chunk in iter(lambda: f.read(FETCH_CHUNK_SIZE), b''):
+            writer.write(chunk)
+
+
+def _parse_ical_path(path, after, before, max_size):
+    with open(path, 'rb') as file:
+        return parse_ical(file, after, before, max_size)
+
+
+def parse_ical(file, after, before, max_size=None):
+    """
+    Parses the ical file component by component, skips the events which can't happen within the period.
+    The whole file is never kept in memory, only the components which may happen.
+    The events are parsed as soon as they are read, only the events referring to the time zones
+    not defined yet are kept as bytes to be parsed at the end of the file.
+    :param file: binary file object to read the ical file from
+    :param after: start of the period, aware datetime
+    :param before: end of the period, aware datetime
+    :param max_size: max size of the file in bytes, None for unlimited
+    :return: icalendar.Calendar
+    """
+    after, before = _prune_period(after, before)
+
+    calendar_lines = []
+    timezones = []
+    timezone_ids = set()
+    other_components = []
+    events = []
+
+    for name, lines in iter_ical_components(file, max_size):
+        if name == 'VCALENDAR':
+            calendar_lines.extend(lines)
+        elif name == 'VEVENT':
+            if _may_happen(lines, after, before):
+                ical = b''.join(lines)
+                if _event_timezone_ids(ical) <= timezone_ids:
+                    events.append(icalendar.Component.from_ical(ical))
+                else:
+                    # time zones are resolved while parsing, the time zone may be defined later in the file
+                    events.append(ical)
+        elif name == 'VTIMEZONE':
+            timezone = icalendar.Component.from_ical(b''.join(lines))
+            timezones.append(timezone)
+            timezone_ids.add(str(timezone.get('TZID')))
+        else:
+            other_components.append(icalendar.Component.from_ical(b''.join(lines)))
+
+    vcalendar = icalendar.Calendar.from_ical(b''.join(calendar_lines))
+    for component in timezones + other_components:
+        vcalendar.add_component(component)
+    for index, event in enumerate(events):
+        if isinstance(event, bytes):
+            # all time zones are known now
+            event = events[index] = icalendar.Component.from_ical(event)
+        vcalendar.add_component(event)
+    return vcalendar
+
+
+def _event_timezone_ids(ical):
+    """
+    Finds the time zones the event refers to by TZID parameters
+    :param ical: the event as bytes
+    :return: set of TZID values
+    """
+    if b'TZID' not in ical.upper():
+        return set()
+    unfolded = re.sub(rb'\r?\n[ \t]', b'', ical)
+    return {match.decode('utf-8', 'replace') for match in TZID_PARAM.findall(unfolded)}
+
+
+def iter_ical_components(file, max_size=None):
+    """
+    Reads the ical file line by line and yields the components of the calendar one by one.
+    Properties of the calendar itself, as well as BEGIN:VCALENDAR and END:VCALENDAR lines,
+    are yielded line by line as VCALENDAR component.
+    :param file: binary file object to read the ical file from
+    :param max_size: max size of the file in bytes, None for unlimited
+    :return: it's generator, yields tuples of the component name and the list of its lines as bytes
+    """
+    size = 0
+    name = None
+    component = None
+    depth = 0
+
+    for line in file:
+        size += len(line)
+        if max_size is not None and size > max_size:
+            raise ValueError(f'The ical file is larger than {max_size} bytes')
+
+        upper_line = line.rstrip().upper()
+        if component is None:
+            if upper_line.startswith(b'BEGIN:') and upper_line != b'BEGIN:VCALENDAR':
+                name = upper_line[6:].decode()
+                component = [line]
+                depth = 1
+            else:
+                yield 'VCALENDAR', [line]
+            continue
+
+        component.append(line)
+        if upper_line.startswith(b'BEGIN:'):
+            depth += 1
+        elif upper_line.startswith(b'END:'):
+            depth -= 1
+        if depth == 0:
+            yield name, component
+            component = None
+
+    if component is not None:
+        raise ValueError(f'The ical file ends inside of {name}')
+
+
+def _prune_period(after, before):
+    return (after.astimezone(pytz.UTC).replace(tzinfo=None) - PRUNE_MARGIN,
+            before.astimezone(pytz.UTC).replace(tzinfo=None) + PRUNE_MARGIN)
+
+
+def _may_happen(lines, after, before):
+    properties = _event_properties(lines)
+    try:
+        start = _ical_datetime(properties[b'DTSTART'])
+        if b'DTEND' in properties:
+            duration = max(_ical_datetime(properties[b'DTEND']) - start, timedelta())
+        elif b'DURATION' in properties:
+            duration = max(icalendar.vDuration.from_ical(properties[b'DURATION'].decode()), timedelta())
+        elif len(properties[b'DTSTART']) == 8:
+            duration = timedelta(days=1)
+        else:
+            duration = timedelta()
+
+        if b'RDATE' in properties:
+            return True
+        if b'RRULE' in properties:
+            last_start = _rule_last_start(properties[b'RRULE'], start)
+            return last_start is None or last_start + duration >= after
+        if b'RECURRENCE-ID' in properties:
+            recurrence_id = _ical_datetime(properties[b'RECURRENCE-ID'])
+            return (max(recurrence_id, start + duration) >= after
+                    and min(recurrence_id, start) <= before)
+        return start + duration >= after and start <= before
+    except Exception:
+        return True     # keep the event which can't be checked, the parser decides
+
+
+def _event_properties(lines):
+    """
+    Unfolds the lines of the event, skips nested components.
+    :return: dict of the first values of the properties, by the upper cased property name
+    """
+    unfolded = []
+    depth = 0
+    for line in lines[1:-1]:
+        if line[:1] in (b' ', b'\t'):
+            if depth == 0 and unfolded:
+                unfolded[-1] += line[1:].rstrip(b'\r\n')
+            continue
+        name = line.rstrip().upper()
+        if name.startswith(b'BEGIN:'):
+            depth += 1
+        elif name.startswith(b'END:'):
+            depth -= 1
+        elif depth == 0:
+            unfolded.append(line.rstrip(b'\r\n'))
+
+    properties = {}
+    for line in unfolded:
+        name_params, _, value = line.partition(b':')
+        name = name_params.partition(b';')[0].upper()
+        properties.setdefault(name, value.strip())
+    return properties
+
+
+def _ical_datetime(value):
+    """
+    Reads naive datetime from the ical date or date-time value, the time zone is ignored.
+    """
+    if len(value) >= 15 and value[8:9] == b'T':
+        return datetime.strptime(value[:15].decode(), '%Y%m%dT%H%M%S')
+    return datetime.strptime(value[:8].decode(), '%Y%m%d')
+
+
+def _rule_last_start(rule, start):
+    """
+    Finds the start of the last repetition of the repeating event.
+    :return: naive datetime, None if the event repeats infinitely or too many times
+    """
+    parts = dict(part.split(b'=', 1) for part in rule.upper().split(b';') if b'=' in part)
+    if b'UNTIL' in parts:
+        return _ical_datetime(parts[b'UNTIL'])
+    if b'COUNT' in parts and int(parts[b'COUNT']) <= MAX_PRUNED_COUNT:
+        return list(rrulestr(rule.decode(), dtstart=start))[-1]
+    return None
+
+
+class CalendarSettings:
+    """
+    Settings of the calendar config needed to read the ical file.
+    It's passed to the executor instead of the config, which is bound to its storage.
+    """
+
+    __slots__ = ('url', 'advance', 'day_start', 'max_ical_size')
+
+    def __init__(self, config):
+        self.url = config.url
+        self.advance = list(config.advance)
+        self.day_start = config.day_start
+        self.max_ical_size = config.max_ical_size
+
+
+def _expand_calendar(settings, vcalendar, expanded, lookahead):
+    return Calendar(settings, vcalendar, expanded, lookahead, select=False)
+
 
 class Calendar:
     """
     Calendar, as it was read from ical file.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, ical=None, expanded=None, lookahead=timedelta(), select=True):
+        """
+        Reads the calendar and selects events to be notified.
+        :param config: CalendarConfig, or CalendarSettings if the events are not selected
+        :param ical: already downloaded content of the ical file, or already parsed icalendar.Calendar,
+            None to download it from the url
+        :param expanded: Expansion of the same parsed ical file by the previous read, None to expand all events
+        :param lookahead: timedelta, also read events happening so long after the advance,
+            to schedule their notifications
+        :param select: whether to select the events to be notified, otherwise select_events() is called later
+        """
         self.url = config.url
         """url of the ical file, from persisted config"""
         self.advance = config.advance
         """array of the numbers: how many hours in advance notify about the event, from persisted config"""
         self.day_start = config.day_start
         """when the day starts if the event has no specified time, from persisted config"""
+        self.max_ical_size = config.max_ical_size
+        """max size of the ical file in bytes, from persisted config"""
+        self.lookahead = lookahead
+        """how long after the advance the events are read"""
         self.name = None
         """name of the calendar, from ical file"""
         self.timezone = pytz.UTC
         """timezone of the calendar, from ical file"""
         self.description = None
         """description of the calendar, from ical file"""
+        self.expansion = None
+        """Expansion of the events read from ical file, to be passed to the next read of the same file"""
+        self.changed = None
+        """whether the ical file content changed since the previous read, None if unknown"""
+        self.hash = None
+        """SHA-256 hex digest of the ical file content, None if unknown"""
+        self.fetched_bytes = 0
+        """number of the bytes downloaded by the read, 0 if the file was not modified"""
+        self.parse_time = 0.0
+        """seconds spent to parse the ical file and expand the events by the read"""
 
         after = datetime.now(tz=pytz.UTC)
-        before = after + timedelta(hours=max(self.advance))
+        before = after + timedelta(hours=max(self.advance)) + lookahead
 
-        self.all_events = list(self.read_ical(self.url, after, before))
+        self.all_events = list(self.read_ical(self.url, after, before, ical, expanded))
         """list of all calendar events, from ical file"""
 
-        unnotified_events = filter_notified_events(self.all_events, config)
-        sorted_events = sort_events(unnotified_events)
-
-        self.events = list(sorted_events)
+        self.events = []
         """list of calendar events which should be notified, filtered from ical file"""
+        if select:
+            self.select_events(config)
 
-    def read_ical(self, url, after, before):
+    def select_events(self, config):
+        """
+        Selects the events to be notified, which were not notified yet.
+        It reads the state of the events from the config, so it's not called in the executor.
+        :param config: CalendarConfig
+        :return: None
+        """
+        unnotified_events = filter_notified_events(self.all_events, config)
+        self.events = list(sort_events(unnotified_events))
+
+    def for_config(self, config):
+        """
+        Copies the calendar for another config with the same url.
+        Keeps only the events within the advance of the config
+        and selects the events to be notified for the config.
+        :param config: CalendarConfig
+        :return: Calendar instance
+        """
+        calendar = copy.copy(self)
+        calendar.advance = config.advance
+        # the download and parsing are charged to the calendar the file was read for
+        calendar.fetched_bytes = 0
+        calendar.parse_time = 0.0
+        calendar.day_start = config.day_start
+
+        before = datetime.now(tz=pytz.UTC) + timedelta(hours=max(config.advance)) + self.lookahead
+        calendar.all_events = [copy.copy(event) for event in self.all_events if event.notify_datetime <= before]
+        calendar.select_events(config)
+        return calendar
+
+    def read_ical(self, url, after, before, ical=None, expanded=None):
         """
         Reads ical file from url.
         :param url: url to read
         :param after: also generate repeating events after this datetime
         :param before: also generate repeating events before this datetime
+        :param ical: already downloaded content of the ical file, or already parsed icalendar.Calendar,
+            None to download it from the url
+        :param expanded: Expansion of the same parsed ical file by the previous read,
+            the events are expanded only after its end
         :return: it's generator, yields each event read from ical
         """
-        # TODO also filter past events to avoid reading of the whole calendar
-        logger.info('Getting %s', url)
-        with urlopen(url) as f:
-            timezone_set = 'none'
-            vcalendar = icalendar.Calendar.from_ical(f.read())
-            self.name = str(vcalendar.get('X-WR-CALNAME'))
-            self.description = str(vcalendar.get('X-WR-CALDESC'))
-
-            if vcalendar.get('X-WR-TIMEZONE') is not None:
-                self.timezone = pytz.timezone(str(vcalendar.get('X-WR-TIMEZONE')))
-                timezone_set = 'x-wr-timezone'
-
-            for component in vcalendar.walk():
-                if component.name == 'VTIMEZONE' and timezone_set in ('none', 'x-wr-timezone'):
-                    try:
-                        self.timezone = pytz.timezone(str(component.get('TZID')))
-                        timezone_set = 'vtimezone.tzid'
-                    except Exception as e:
-                        logger.warning(e)
-
-            for event in recurring_ical_events.of(vcalendar).between(after, before):
-                yield Event.from_vevent(event, self.timezone, self.day_start)
+        timezone_set = 'none'
+        if isinstance(ical, icalendar.Calendar):
+            vcalendar = ical
+        elif ical is None:
+            logger.info('Getting %s', url)
+            with urlopen(url, timeout=FETCH_TIMEOUT) as f:
+                vcalendar = parse_ical(f, after, before, self.max_ical_size)
+        else:
+            vcalendar = parse_ical(io.BytesIO(ical), after, before, self.max_ical_size)
+        self.name = str(vcalendar.get('X-WR-CALNAME'))
+        self.description = str(vcalendar.get('X-WR-CALDESC'))
+
+        if vcalendar.get('X-WR-TIMEZONE') is not None:
+            self.timezone = pytz.timezone(str(vcalendar.get('X-WR-TIMEZONE')))
+            timezone_set = 'x-wr-timezone'
+
+        for component in vcalendar.walk():
+            if component.name == 'VTIMEZONE' and timezone_set in ('none', 'x-wr-timezone'):
+                try:
+                    self.timezone = pytz.timezone(str(component.get('TZID')))
+                    timezone_set = 'vtimezone.tzid'
+                except Exception as e:
+                    logger.warning(e)
+
+        events = []
+        if expanded is not None and after <= expanded.until:
+            # the previous expansion continues to the current period, keep the events which are not ended yet,
+            # including the events after the current period, they are kept for the next wider read
+            for event in expanded.events:
+                if _event_overlaps(event, after, expanded.until):
+                    events.append(copy.copy(event))
+            expand_after = expanded.until
+        else:
+            expand_after = after
+
+        if expand_after < before:
+            expanded_ids = set(event.id for event in events)
+            for vevent in recurring_ical_events.of(vcalendar).between(expand_after, before):
+                event = Event.from_vevent(vevent, self.timezone, self.day_start)
+                # the events overlapping the end of the previous expansion are expanded again
+                if event.id not in expanded_ids:
+                    events.append(event)
+
+        self.expansion = Expansion(max(before, expand_after), events)
+        for event in events:
+            if _event_overlaps(event, after, before):
+                yield event
 
 
 class Event:
@@ -101,6 +687,9 @@ class Event:
     Calendar event as it was read from ical file.
     """
 
+    __slots__ = ('id', 'uid', 'instance_id', 'title', 'location', 'description', 'date', 'time',
+                 'notify_datetime', 'notified_for_advance', 'day_start', 'end')
+
     def __init__(self, **kwargs):
         self.id = kwargs['id']
         """unique id of the event"""
@@ -125,13 +714,15 @@ class Event:
         """hours in advance for which this event should be notified"""
         self.day_start = kwargs.get('day_start')
         """notification time for full-day events"""
+        self.end = kwargs.get('end')
+        """the moment the event ends, can be None"""
 
     def __repr__(self):
         return f'Event(id={self.id}, uid={self.uid}, instance_id={self.instance_id}, ' \
                f'title={self.title}, location={self.location}, description={self.description}, ' \
                f'date={self.date}, time={self.time}, notify_datetime={self.notify_datetime}, ' \
                f'notified_for_advance={self.notified_for_advance}, ' \
-               f'day_start={self.day_start})'
+               f'day_start={self.day_start}, end={self.end})'
 
     @classmethod
     def from_vevent(cls, vevent, timezone, day_start=None):
@@ -143,7 +734,8 @@ class Event:
         :return: calendar event instance
         """
 
-        event_uid = str(vevent.get('UID'))
+        # the same ids are kept by the event configs, so they are shared
+        event_uid = sys.intern(str(vevent.get('UID')))
         event_title = str(vevent.get('SUMMARY'))
         event_location = str(vevent.get('LOCATION'))
         event_description = str(vevent.get('DESCRIPTION'))
@@ -165,12 +757,14 @@ class Event:
         if notify_datetime is None:
             event_id = event_uid
         else:
-            event_id = "%s_%s" % (event_uid, notify_datetime.isoformat())
+            event_id = sys.intern("%s_%s" % (event_uid, notify_datetime.isoformat()))
 
         event_instance_id = (event_uid, notify_datetime)
 
         event_day_start = day_start.replace(tzinfo=timezone) if day_start is not None else None
 
+        event_end = _event_end(vevent, timezone)
+
         return cls(
             id=event_id,
             uid=event_uid,
@@ -181,7 +775,8 @@ class Event:
             date=event_date,
             time=event_time,
             notify_datetime=notify_datetime,
-            day_start=event_day_start
+            day_start=event_day_start,
+            end=event_end
         )
 
     def to_dict(self):
@@ -236,6 +831,40 @@ def timezoned(dt, timezone):
         return dt
 
 
+def _event_end(vevent, timezone):
+    """
+    Calculates the moment the event ends, as the events are expanded by recurring_ical_events.
+    :param vevent: vEvent component
+    :param timezone: default timezone for the calendar
+    :return: aware datetime
+    """
+    dtstart = vevent.get('DTSTART').dt
+    if vevent.get('DTEND') is not None:
+        end = vevent.get('DTEND').dt
+    elif vevent.get('DURATION') is not None:
+        end = dtstart + vevent.get('DURATION').dt
+    elif isinstance(dtstart, datetime):
+        end = dtstart
+    else:
+        end = dtstart + timedelta(days=1)
+    if not isinstance(end, datetime):
+        end = datetime.combine(end, time())
+    return timezoned(end, timezone)
+
+
+def _event_overlaps(event, after, before):
+    """
+    Checks whether the already expanded event is expanded for the period.
+    :param event: Event
+    :param after: start of the period
+    :param before: end of the period
+    :return: True if the event overlaps the period
+    """
+    start = event.notify_datetime
+    end = event.end if event.end is not None else start
+    return start < before and (end > after or (end == start and start >= after))
+
+
 def _get_sample_event():
     now = datetime.now(tz=pytz.timezone('Asia/Omsk'))
     return Event(
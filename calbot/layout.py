@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Layout of the users directories in the var directory.
+
+By default, the directory of each user is directly in the var directory: `var/<chat_id>/`.
+The sharded layout spreads the users over two levels of hashed directories:
+`var/users/ab/cd/<chat_id>/`, it's enabled when `var/users` directory exists.
+The flat directories are still found until they are moved,
+so the var directory can be migrated while the bot is running:
+
+```
+python -m calbot.layout calbot.cfg
+```
+"""
+
+import hashlib
+import logging
+import os
+import sys
+
+__all__ = ["user_dir", "user_ids", "migrate"]
+
+logger = logging.getLogger("layout")
+
+SHARDS_DIR = "users"
+
+RESERVED_DIRS = {SHARDS_DIR, "journal"}
+
+_sharded_dirs = {}
+"""directories of the users resolved to the sharded layout, by (vardir, user_id), they are never moved back"""
+
+
+def shard(user_id):
+    """
+    Calculates the shard directories of the user
+    :param user_id: user ID as string
+    :return: tuple of two directory names
+    """
+    digest = hashlib.md5(user_id.encode("UTF-8")).hexdigest()
+    return digest[:2], digest[2:4]
+
+
+def user_dir(vardir, user_id):
+    """
+    Finds the directory of the user, it may not exist yet.
+    The sharded directories are resolved once,
+    the flat directories are checked again until they are moved.
+    :param vardir: basic var dir
+    :param user_id: user ID as string
+    :return: path to the directory
+    """
+    sharded_dir = _sharded_dirs.get((vardir, user_id))
+    if sharded_dir is not None:
+        return sharded_dir
+    shards_dir = os.path.join(vardir, SHARDS_DIR)
+    flat_dir = os.path.join(vardir, user_id)
+    if not os.path.isdir(shards_dir):
+        return flat_dir
+    sharded_dir = os.path.join(shards_dir, *shard(user_id), user_id)
+    if os.path.isdir(flat_dir) and not os.path.isdir(sharded_dir):
+        # not migrated yet
+        return flat_dir
+    _sharded_dirs[(vardir, user_id)] = sharded_dir
+    return sharded_dir
+
+
+def user_ids(vardir):
+    """
+    Lists the users having a directory, in both layouts.
+    :param vardir: basic var dir
+    :return: list of user IDs
+    """
+    result = [entry.name for entry in _subdirs(vardir) if entry.name not in RESERVED_DIRS]
+    shards_dir = os.path.join(vardir, SHARDS_DIR)
+    if os.path.isdir(shards_dir):
+        for level1 in _subdirs(shards_dir):
+            for level2 in _subdirs(level1.path):
+                result.extend(entry.name for entry in _subdirs(level2.path))
+    return list(dict.fromkeys(result))
+
+
+def _subdirs(path):
+    with os.scandir(path) as entries:
+        return [entry for entry in entries if entry.is_dir()]
+
+
+def migrate(vardir):
+    """
+    Moves the users directories to the sharded layout.
+    New users get the sharded directories as soon as the migration starts.
+    Can be run again to move the directories created by the bot during the migration.
+    :param vardir: basic var dir
+    :return: number of moved users
+    """
+    os.makedirs(os.path.join(vardir, SHARDS_DIR), exist_ok=True)
+    moved = 0
+    for entry in _subdirs(vardir):
+        if entry.name in RESERVED_DIRS:
+            continue
+        target = os.path.join(vardir, SHARDS_DIR, *shard(entry.name), entry.name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.isdir(target):
+            _merge(entry.path, target)
+        else:
+            os.rename(entry.path, target)
+        moved += 1
+        if moved % 1000 == 0:
+            logger.info("Moved %s users", moved)
+    logger.info("Moved %s users to %s", moved, os.path.join(vardir, SHARDS_DIR))
+    return moved
+
+
+def _merge(source, target):
+    """
+    Moves the files of the directory into the existing one, the moved files replace the existing.
+    """
+    with os.scandir(source) as entries:
+        for entry in list(entries):
+            target_path = os.path.join(target, entry.name)
+            if entry.is_dir() and os.path.isdir(target_path):
+                _merge(entry.path, target_path)
+            else:
+                os.replace(entry.path, target_path)
+    os.rmdir(source)
+
+
+def main():
+    from calbot.conf import Config
+
+    if len(sys.argv) < 2:
+        print("Usage: python -m calbot.layout calbot.cfg", file=sys.stderr)
+        sys.exit(1)
+    config = Config(sys.argv[1])
+    migrate(config.vardir)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    main()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Metrics of the calendars processing, exposed in Prometheus text format.
+"""
+
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ["registry", "MetricsServer"]
+
+logger = logging.getLogger("metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+LATENESS_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 21600.0, 86400.0, math.inf)
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by the labels.
+    """
+
+    def __init__(self, lock, name, documentation, labelnames=()):
+        self.lock = lock
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        """counted values, by tuple of the label values"""
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        if not self.labelnames and not self.values:
+            lines.append("%s 0" % self.name)
+        for key, value in sorted(self.values.items()):
+            lines.append("%s%s %s" % (self.name, _labels(zip(self.labelnames, key)), _number(value)))
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of the observed values by the buckets.
+    """
+
+    def __init__(self, lock, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.lock = lock
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        """numbers of the observations by the bucket, not cumulative"""
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the duration of the block, in seconds.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append("%s_bucket%s %s" % (self.name, _labels([("le", _number(bound))]), cumulative))
+        lines.append("%s_sum %s" % (self.name, _number(self.sum)))
+        lines.append("%s_count %s" % (self.name, self.count))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Keeps the metrics to be rendered together.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        """guards the values of the metrics, they are rendered in the server thread"""
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(self.lock, name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self.lock, name, documentation, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Renders all metrics in Prometheus text format.
+        :return: string
+        """
+        with self.lock:
+            lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+"""the metrics of the bot"""
+
+fetch_seconds = registry.histogram("calbot_fetch_seconds", "Time to download the ical file.")
+fetched_bytes = registry.counter("calbot_fetched_bytes_total", "Bytes of the downloaded ical files.")
+parse_seconds = registry.histogram("calbot_parse_seconds", "Time to parse the ical file.")
+expand_seconds = registry.histogram("calbot_expand_seconds", "Time to expand the recurring events.")
+format_seconds = registry.histogram("calbot_format_seconds", "Time to format the event notification.")
+send_seconds = registry.histogram("calbot_send_seconds", "Latency of sending the message to Telegram.")
+lateness_seconds = registry.histogram(
+    "calbot_notification_lateness_seconds",
+    "Delay of the sent notification after the event moment minus the advance.",
+    LATENESS_BUCKETS,
+)
+errors = registry.counter(
+    "calbot_errors_total", "Errors of the calendars processing and notifications.", ("stage", "error")
+)
+
+
+class MetricsServer:
+    """
+    Serves the metrics on the local HTTP port, in the background thread.
+    """
+
+    def __init__(self, listen, port, metrics_registry=registry):
+        """
+        Creates the server
+        :param listen: address to listen
+        :param port: port to listen, 0 to choose a free one
+        :param metrics_registry: MetricsRegistry to serve
+        """
+        self.metrics_registry = metrics_registry
+        self.server = ThreadingHTTPServer((listen, port), self._handler())
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        logger.info("Serving metrics on port %s", self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        metrics_registry = self.metrics_registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics_registry.render().encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return MetricsHandler
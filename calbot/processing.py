@@ -19,11 +19,17 @@
 
 # -*- coding: utf-8 -*-
 
+import asyncio
 import logging
+import time
+from datetime import datetime, timedelta, timezone
+
 from telegram.ext import ContextTypes
 
+from calbot import metrics
 from calbot.formatting import format_event
-from calbot.ical import Calendar
+from calbot.history import Record, percentile
+from calbot.ical import CalendarReader, expanded_calendars, parsed_calendars
 from calbot.stats import update_stats
 
 __all__ = ["update_calendars_job", "update_calendars", "update_calendar"]
@@ -31,10 +37,52 @@ __all__ = ["update_calendars_job", "update_calendars", "update_calendar"]
 logger = logging.getLogger("processing")
 
 
+class EventsCompaction:
+    """
+    Counts the work of the compaction of the notified events state.
+    """
+
+    def __init__(self):
+        self.calendars = 0
+        """number of the compacted calendars"""
+        self.dropped = 0
+        """number of the dropped expired events"""
+
+
+events_compaction = EventsCompaction()
+
+
+class NotificationsLateness:
+    """
+    Collects the lateness of the sent notifications between the processing cycles.
+    """
+
+    def __init__(self):
+        self.values = []
+        """lateness of the notifications sent since the last take(), in seconds"""
+        self.alerted = False
+        """whether the admins were alerted the lateness is over the threshold"""
+
+    def observe(self, seconds):
+        self.values.append(seconds)
+        metrics.lateness_seconds.observe(seconds)
+
+    def take(self):
+        """
+        Takes the collected lateness and starts collecting again.
+        :return: list of the lateness of the sent notifications, in seconds
+        """
+        values, self.values = self.values, []
+        return values
+
+
+notifications_lateness = NotificationsLateness()
+
+
 async def update_calendars_job(context: ContextTypes.DEFAULT_TYPE):
     """
     Job queue callback.
-    Runs the update of all calendars one by one.
+    Runs the update of all calendars.
     Finally, updates statistics.
     """
     config = context.job.data
@@ -43,20 +91,100 @@ async def update_calendars_job(context: ContextTypes.DEFAULT_TYPE):
 
 async def update_calendars(context: ContextTypes.DEFAULT_TYPE, config):
     """
-    Runs the update of all calendars one by one.
+    Runs the update of all calendars which are due to be read concurrently,
+    no more than config.concurrency calendars at the same time.
     Finally, updates statistics.
     """
-    for calendar in config.all_calendars():
-        await update_calendar(context, calendar)
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(config.concurrency)
+
+    async def update_calendar_limited(calendar):
+        async with semaphore:
+            return await update_calendar(context, calendar, reader)
+
+    # the calendars due before the next run are read now, only they are loaded,
+    # all calendars are read by the first run to schedule their notifications after the start
+    # the counters are cumulative, the cycle logs its own share
+    parsed_hits, parsed_misses = parsed_calendars.hits, parsed_calendars.misses
+    expanded_hits, expanded_misses = expanded_calendars.hits, expanded_calendars.misses
+    dropped, compacted = events_compaction.dropped, events_compaction.calendars
+
+    scheduler = context.bot_data.get("scheduler")
+    read_all = scheduler is not None and not scheduler.primed
+    entries = config.storage.registry()
+    due_before = datetime.utcnow() + timedelta(seconds=config.min_interval / 2)
+
+    # the calendars state is written once per user at the end of the cycle,
+    # only the calendars loaded for the cycle write behind, the commands write through meanwhile
+    with config.delayed_writes() as cycle_config:
+        due_calendars = list(
+            cycle_config.load_registered_calendars(
+                entry for entry in entries if entry.enabled and (read_all or entry.check_due(due_before))
+            )
+        )
+        reader = _create_reader(context, due_calendars)
+        logger.info(
+            "Processing %s of %s calendars from %s urls, %s at once",
+            len(due_calendars),
+            len(entries),
+            len(reader.primary_configs),
+            config.concurrency,
+        )
+        results = await asyncio.gather(*map(update_calendar_limited, due_calendars))
+
+    if scheduler is not None:
+        scheduler.retain(
+            (entry.user_id, entry.cal_id) for entry in config.storage.registry() if entry.enabled
+        )
+        scheduler.primed = True
+
+    duration = time.monotonic() - started
+    logger.info(
+        "Processed %s calendars in %.3f s: %s succeeded, %s failed, %s skipped",
+        len(due_calendars),
+        duration,
+        results.count(True),
+        results.count(False),
+        results.count(None),
+    )
+    logger.info(
+        "Parsed calendars cache: %s hits, %s misses; expanded calendars cache: %s hits, %s misses",
+        parsed_calendars.hits - parsed_hits,
+        parsed_calendars.misses - parsed_misses,
+        expanded_calendars.hits - expanded_hits,
+        expanded_calendars.misses - expanded_misses,
+    )
+    logger.info(
+        "Events compaction: %s expired events dropped from %s calendars",
+        events_compaction.dropped - dropped,
+        events_compaction.calendars - compacted,
+    )
+
+    lateness = notifications_lateness.take()
+    await check_lateness(context, config, lateness)
 
-    update_stats(config)
+    update_stats(
+        config,
+        Record(
+            time=time.time(),
+            duration=duration,
+            calendars=len([entry for entry in config.storage.registry() if entry.enabled]),
+            processed=len(due_calendars),
+            failed=results.count(False),
+            sent=len(lateness),
+        ),
+    )
 
 
-async def update_calendar(context: ContextTypes.DEFAULT_TYPE, config):
+async def update_calendar(context: ContextTypes.DEFAULT_TYPE, config, reader=None):
     """
     Update data from the calendar.
     Reads ical file and notifies events if necessary.
+    Schedules the next read of the calendar, depending on whether the ical file was changed.
+    If the notification scheduler is running, the events are scheduled to be notified exactly in time.
     After the first successful read the calendar is marked as validated.
+    :param reader: CalendarReader shared by calendars processed together, None to read the calendar alone
+    :return: True if the calendar was processed, False if failed, None if skipped
     """
     if not config.enabled:
         logger.info(
@@ -64,12 +192,15 @@ async def update_calendar(context: ContextTypes.DEFAULT_TYPE, config):
             config.id,
             config.user_id,
         )
-        return
+        return None
 
     bot = context.bot
+    started = time.monotonic()
+    if reader is None:
+        reader = _create_reader(context, [config])
 
     try:
-        calendar = Calendar(config)
+        calendar = await reader.read(config)
 
         if not config.verified:
             await bot.send_message(
@@ -89,12 +220,41 @@ async def update_calendar(context: ContextTypes.DEFAULT_TYPE, config):
                 ),
             )
 
-        for event in calendar.events:
-            await send_event(context, config, event)
-            config.event_notified(event)
-            config.save_events()
+        scheduler = context.bot_data.get("scheduler")
+        if scheduler is not None:
+            # the notifications scheduled by the previous read are counted
+            sends = scheduler.take_sent(config)
+            scheduler.schedule(config, calendar)
+        else:
+            sends = 0
+            for event in calendar.events:
+                await send_event(context, config, event)
+                config.save_event_notified(event)
+                sends += 1
 
+        # the notifications appended to the ledger are saved once per read,
+        # the expired events are dropped, unless they are still in the calendar
+        expired_before = datetime.now(tz=timezone.utc) - timedelta(seconds=config.events_retention)
+        events_compaction.dropped += config.compact_events(
+            expired_before, (event.id for event in calendar.all_events)
+        )
+        events_compaction.calendars += 1
         config.save_error(None)
+        config.save_check(calendar.changed)
+        config.save_cost(
+            fetch_bytes=calendar.fetched_bytes,
+            parse_time=calendar.parse_time,
+            instances=len(calendar.all_events),
+            sends=sends,
+        )
+
+        logger.info(
+            "Processed calendar %s of user %s in %.3f s",
+            config.id,
+            config.user_id,
+            time.monotonic() - started,
+        )
+        return True
 
     except Exception as e:
         logger.warning(
@@ -103,9 +263,11 @@ async def update_calendar(context: ContextTypes.DEFAULT_TYPE, config):
             config.user_id,
             exc_info=True,
         )
+        metrics.errors.inc(stage="process", error=type(e).__name__)
 
         was_enabled = config.enabled
         config.save_error(e)
+        config.save_check(None)
 
         if was_enabled and not config.verified:
             try:
@@ -136,6 +298,14 @@ async def update_calendar(context: ContextTypes.DEFAULT_TYPE, config):
                     exc_info=True,
                 )
 
+        return False
+
+
+def _create_reader(context, configs):
+    scheduler = context.bot_data.get("scheduler")
+    lookahead = scheduler.lookahead if scheduler is not None else timedelta()
+    return CalendarReader(configs, context.bot_data.get("executor"), lookahead)
+
 
 async def send_event(context: ContextTypes.DEFAULT_TYPE, config, event):
     """
@@ -148,7 +318,46 @@ async def send_event(context: ContextTypes.DEFAULT_TYPE, config, event):
         config.channel_id,
     )
 
-    await context.bot.send_message(
-        chat_id=config.channel_id,
-        text=format_event(config, event),
-    )
+    with metrics.format_seconds.time():
+        text = format_event(config, event)
+    with metrics.send_seconds.time():
+        await context.bot.send_message(
+            chat_id=config.channel_id,
+            text=text,
+        )
+
+    if event.notify_datetime is not None and event.notified_for_advance is not None:
+        # the events added to the calendar after their ideal moment are counted as late too
+        ideal = event.notify_datetime - timedelta(hours=event.notified_for_advance)
+        notifications_lateness.observe(max((datetime.now(tz=timezone.utc) - ideal).total_seconds(), 0.0))
+
+
+async def check_lateness(context: ContextTypes.DEFAULT_TYPE, config, lateness):
+    """
+    Alerts the admins when the 95th percentile of the notifications lateness goes over config.lateness_alert,
+    and when it's back under the threshold.
+    :param lateness: list of the lateness of the notifications sent since the previous check, in seconds
+    :return: None
+    """
+    if config.lateness_alert <= 0 or not lateness:
+        return
+    p95 = percentile(sorted(lateness), 95)
+    over = p95 > config.lateness_alert
+    if over == notifications_lateness.alerted:
+        return
+    notifications_lateness.alerted = over
+
+    if over:
+        text = f"Notifications are late: p95 {p95:.0f} s of {len(lateness)} notifications"
+    else:
+        text = f"Notifications are in time again: p95 {p95:.0f} s of {len(lateness)} notifications"
+    logger.warning(text)
+    for admin_id in config.admins:
+        try:
+            await context.bot.send_message(chat_id=admin_id, text=text)
+        except Exception:
+            logger.error(
+                "Failed to send message to user %s",
+                admin_id,
+                exc_info=True,
+            )
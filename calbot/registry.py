@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+from configparser import ConfigParser
+from datetime import datetime
+
+__all__ = ["RegistryEntry", "check_due"]
+
+
+class RegistryEntry:
+    """
+    Indexed state of the calendar, enough to decide whether to load and process it.
+    """
+
+    def __init__(self, user_id, cal_id, enabled=True, next_check_at=None):
+        self.user_id = user_id
+        """Chat ID of the user to whom the calendar belongs to"""
+        self.cal_id = cal_id
+        """ID of the calendar"""
+        self.enabled = enabled
+        """Flag calendar is enabled and should be processed"""
+        self.next_check_at = next_check_at
+        """Moment when the calendar should be read next time, None to read it as soon as possible"""
+
+    @classmethod
+    def from_options(cls, user_id, cal_id, options):
+        """
+        Creates the entry from the calendar options
+        :param user_id: ID of the user
+        :param cal_id: ID of the calendar
+        :param options: dict-like of the persisted options of the calendar
+        :return: RegistryEntry instance
+        """
+        enabled = str(options.get("enabled") or "true").lower()
+        return cls(
+            user_id,
+            cal_id,
+            ConfigParser.BOOLEAN_STATES.get(enabled, True),
+            options.get("next_check_at"),
+        )
+
+    def check_due(self, moment):
+        return check_due(self.next_check_at, moment)
+
+
+def check_due(next_check_at, moment):
+    """
+    Checks whether the calendar should be read.
+    :param next_check_at: moment of the next read as ISO string, can be None
+    :param moment: naive UTC datetime, the calendar is due if it should be read before it
+    :return: True if the calendar should be read
+    """
+    if next_check_at is None:
+        return True
+    try:
+        return datetime.fromisoformat(next_check_at) <= moment
+    except ValueError:
+        return True
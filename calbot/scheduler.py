@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+from telegram.ext import ContextTypes
+
+from calbot import metrics
+from calbot.processing import send_event
+
+__all__ = ["NotificationScheduler"]
+
+logger = logging.getLogger("scheduler")
+
+
+class NotificationScheduler:
+    """
+    Sends the event notifications exactly at the moments they are due.
+    The calendars are read periodically, each read schedules the notifications of the calendar
+    until the next read.
+    The notifications are kept in the heap ordered by the notification moment,
+    one job of the job queue is armed for the nearest one.
+    """
+
+    def __init__(self, job_queue, lookahead=timedelta()):
+        """
+        Creates the scheduler
+        :param job_queue: telegram.ext.JobQueue to arm the notification jobs
+        :param lookahead: timedelta, how far after the advance the calendars should be read,
+            usually the interval between the reads
+        """
+        self.job_queue = job_queue
+        """job queue to arm the notification jobs"""
+        self.lookahead = lookahead
+        """how far after the advance the events are scheduled"""
+        self.heap = []
+        """scheduled notifications: (moment, sequence number, calendar key, generation, event, advance)"""
+        self.configs = {}
+        """the last scheduled CalendarConfig, by (user_id, cal_id)"""
+        self.generations = {}
+        """the generation of the last scheduled notifications, by (user_id, cal_id)"""
+        self.counts = {}
+        """number of the notifications of the last generation in the heap, by (user_id, cal_id)"""
+        self.stale = 0
+        """number of the notifications in the heap replaced by newer generations"""
+        self.sent = {}
+        """number of the notifications sent since the last read of the calendar, by (user_id, cal_id)"""
+        self.in_flight = {}
+        """advance of the notification being sent now, by ((user_id, cal_id), event_id)"""
+        self.sequence = itertools.count()
+        """sequence to keep the order of the notifications scheduled for the same moment"""
+        self.primed = False
+        """whether all enabled calendars were read since the start, the notifications are kept only in memory"""
+        self.job = None
+        """the armed job"""
+        self.armed_at = None
+        """the moment the job is armed for"""
+
+    def schedule(self, config, calendar):
+        """
+        Replaces the scheduled notifications of the calendar.
+        The due notifications are sent immediately.
+        :param config: CalendarConfig
+        :param calendar: Calendar read for the config
+        :return: None
+        """
+        key = (config.user_id, config.id)
+        previous = self.configs.get(key)
+        if previous is not None and previous is not config:
+            _merge_notified(previous, config)
+        self.configs[key] = config
+
+        generation = self.generations.get(key, 0) + 1
+        self.generations[key] = generation
+        self.stale += self.counts.get(key, 0)
+
+        now = datetime.now(tz=pytz.UTC)
+        count = 0
+        for event in calendar.all_events:
+            last_notified = config.event(event.id).last_notified
+            sending = self.in_flight.get((key, event.id))
+            if sending is not None and (last_notified is None or sending < last_notified):
+                # the notification being sent is not saved yet
+                last_notified = sending
+            for advance in sorted(config.advance, reverse=True):
+                if last_notified is not None and last_notified <= advance:
+                    continue
+                moment = event.notify_datetime - timedelta(hours=advance)
+                heapq.heappush(
+                    self.heap,
+                    (max(moment, now), next(self.sequence), key, generation, event, advance),
+                )
+                count += 1
+                if moment <= now:
+                    # only the widest due advance is notified
+                    break
+        self.counts[key] = count
+
+        self._compact()
+        self._arm()
+
+    def take_sent(self, config):
+        """
+        Takes the number of the notifications of the calendar sent since the previous call.
+        :param config: CalendarConfig
+        :return: number of the sent notifications
+        """
+        return self.sent.pop((config.user_id, config.id), 0)
+
+    def retain(self, keys):
+        """
+        Drops the notifications of the calendars which are not in the list, e.g. deleted or disabled.
+        :param keys: iterable of (user_id, cal_id) of the calendars which are still processed
+        :return: None
+        """
+        keys = set(keys)
+        for key in list(self.configs):
+            if key not in keys:
+                self._drop(key)
+        self._compact()
+
+    def drop(self, user_id, cal_id):
+        """
+        Drops the notifications of the calendar, e.g. disabled or deleted by a command.
+        :param user_id: ID of the user
+        :param cal_id: ID of the calendar
+        :return: None
+        """
+        if (user_id, cal_id) in self.configs:
+            self._drop((user_id, cal_id))
+            self._compact()
+
+    def update_advance(self, user_id, advance):
+        """
+        Applies the advance changed by the user to the scheduled calendars of the user.
+        The notifications for the removed hours are not sent,
+        the added hours are scheduled by the next read of the calendars.
+        :param user_id: ID of the user
+        :param advance: list of the hours
+        :return: None
+        """
+        for (config_user_id, _), config in self.configs.items():
+            if config_user_id == user_id:
+                config.advance = list(advance)
+
+    async def notify_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Job queue callback.
+        Sends all due notifications, then arms the job for the next one.
+        The job stays armed until all due notifications are sent,
+        the notifications scheduled meanwhile are sent by the same run.
+        """
+        try:
+            while self.heap and self.heap[0][0] <= datetime.now(tz=pytz.UTC):
+                _, _, key, generation, event, advance = heapq.heappop(self.heap)
+                if self.generations.get(key) != generation:
+                    self.stale -= 1
+                    continue
+                self.counts[key] -= 1
+                await self._notify(context, self.configs[key], event, advance)
+        finally:
+            self.job = None
+            self.armed_at = None
+        self._arm()
+
+    async def _notify(self, context, config, event, advance):
+        if advance not in config.advance:
+            # removed by the user since the calendar was scheduled
+            return
+        last_notified = config.event(event.id).last_notified
+        if last_notified is not None and last_notified <= advance:
+            return
+        key = (config.user_id, config.id)
+        self.in_flight[(key, event.id)] = advance
+        try:
+            event.notified_for_advance = advance
+            await send_event(context, config, event)
+            config.save_event_notified(event)
+            self.sent[key] = self.sent.get(key, 0) + 1
+            current = self.configs.get(key)
+            if current is not None and current is not config:
+                # the calendar was scheduled again while the notification was sent
+                _merge_notified(config, current)
+        except Exception as e:
+            logger.warning(
+                "Failed to notify event %s of calendar %s of user %s",
+                event.id,
+                config.id,
+                config.user_id,
+                exc_info=True,
+            )
+            metrics.errors.inc(stage="notify", error=type(e).__name__)
+            config.save_error(e)
+        finally:
+            del self.in_flight[(key, event.id)]
+
+    def _drop(self, key):
+        del self.configs[key]
+        self.sent.pop(key, None)
+        self.generations[key] = self.generations.get(key, 0) + 1
+        self.stale += self.counts.pop(key, 0)
+
+    def _arm(self):
+        if not self.heap:
+            return
+        moment = self.heap[0][0]
+        if self.job is not None:
+            if self.armed_at <= moment:
+                return
+            self.job.schedule_removal()
+        self.job = self.job_queue.run_once(self.notify_job, when=moment, name="notify")
+        self.armed_at = moment
+
+    def _compact(self):
+        if self.stale <= len(self.heap) // 2:
+            return
+        self.heap = [entry for entry in self.heap if self.generations.get(entry[2]) == entry[3]]
+        heapq.heapify(self.heap)
+        self.stale = 0
+
+
+def _merge_notified(previous, config):
+    """
+    Copies the notifications made with the previous config object of the same calendar,
+    which may be made after the new config object was loaded.
+    """
+    for event_id, previous_event in previous.events.items():
+        if previous_event.last_notified is None:
+            continue
+        event = config.event(event_id)
+        if event.last_notified is None or previous_event.last_notified < event.last_notified:
+            event.last_notified = previous_event.last_notified
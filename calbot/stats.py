@@ -17,15 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
 
-import os
 import datetime
 import logging
-from configparser import ConfigParser
 
-from calbot.conf import ConfigFile
+from calbot.history import StatsHistory
 
 
-__all__ = ['update_stats', 'get_stats']
+__all__ = ['update_stats', 'get_stats', 'get_costs']
 
 logger = logging.getLogger('stats')
 
@@ -36,17 +34,35 @@ Notified events: {}
 Last calendars processed:
 {} - {}"""
 
+COSTS_MESSAGE_FORMAT="""Most expensive calendars:
+{}
+Most expensive users:
+{}"""
 
-def update_stats(config):
+COST_FORMAT = '{} — {:.3f} s, {:.1f} KiB, {:.0f} events, {:.1f} sends'
+
+
+def update_stats(config, cycle=None):
     """
     Updates statistics.
+    Appends the processing cycle to the stats history, saves the changes of the counters,
+    recalculates the counters from all calendars once per stats_interval to correct the drift.
     :param config: Main config object
+    :param cycle: calbot.history.Record of the processing cycle, None to not append it
     :return: None
     """
+    if cycle is not None:
+        try:
+            StatsHistory(config.vardir).append(cycle)
+        except Exception as e:
+            logger.warning('Failed to append stats history', exc_info=True)
+
     try:
-        config_file = StatsConfigFile(config.vardir)
-        parser = ConfigParser(interpolation=None)
-        parser.add_section('stats')
+        reconciled_at = config.stats.read()['reconciled_at']
+        if reconciled_at is not None and datetime.datetime.fromisoformat(reconciled_at) > \
+                datetime.datetime.utcnow() - datetime.timedelta(seconds=config.stats_interval):
+            config.stats.flush()
+            return
 
         users = 0
         calendars = 0
@@ -55,40 +71,103 @@ def update_stats(config):
         last_process_min = datetime.datetime.utcnow().isoformat()
         last_process_max = datetime.datetime.utcfromtimestamp(0).isoformat()
 
-        for name in os.listdir(config.vardir):
-            if os.path.isdir(os.path.join(config.vardir, name)):
-                users += 1
-                user_id = name
-                for calendar in config.load_calendars(user_id):
-                    if calendar.enabled:
-                        calendars += 1
-                        last_process_min = min(calendar.last_process_at or last_process_min, last_process_min)
-                        last_process_max = max(calendar.last_process_at or last_process_max, last_process_max)
-                        calendar.load_events()
-                        events += len(calendar.events)
-                    else:
-                        disabled_calendars += 1
-
-        parser.set('stats', 'users', str(users))
-        parser.set('stats', 'calendars', str(calendars))
-        parser.set('stats', 'disabled_calendars', str(disabled_calendars))
-        parser.set('stats', 'events', str(events))
-        parser.set('stats', 'last_process_min', last_process_min)
-        parser.set('stats', 'last_process_max', last_process_max)
-
-        config_file.write(parser)
+        entries = config.storage.registry()
+        users = len(set(entry.user_id for entry in entries))
+        disabled_calendars = len([entry for entry in entries if not entry.enabled])
+        for calendar in config.load_registered_calendars(entry for entry in entries if entry.enabled):
+            calendars += 1
+            last_process_min = min(calendar.last_process_at or last_process_min, last_process_min)
+            last_process_max = max(calendar.last_process_at or last_process_max, last_process_max)
+            events += calendar.events_count
+
+        config.stats.reset(dict(
+            users=users,
+            calendars=calendars,
+            disabled_calendars=disabled_calendars,
+            events=events,
+            last_process_min=last_process_min,
+            last_process_max=last_process_max,
+        ))
     except Exception as e:
         logger.warning('Failed to update stats', exc_info=True)
 
 
 def get_stats(config):
     """
-    Reads stats object from the stats.cfg file
+    Reads stats object from the stats counters
     :param config: Main Config object
     :return: Stats object
     """
-    config_file = StatsConfigFile(config.vardir)
-    return Stats.load(config_file)
+    return Stats(**config.stats.read())
+
+
+def get_costs(config, top=10):
+    """
+    Finds the enabled calendars and the users which are the most expensive to process,
+    by the average time to parse the calendars, then by the average downloaded bytes
+    :param config: Main Config object
+    :param top: how many calendars and users to list
+    :return: Costs object
+    """
+    calendars = []
+    users = {}
+    entries = config.storage.registry()
+    for calendar in config.load_registered_calendars(entry for entry in entries if entry.enabled):
+        cost = Cost('%s /cal%s %s' % (calendar.user_id, calendar.id, calendar.name))
+        cost.add(calendar)
+        calendars.append(cost)
+        users.setdefault(calendar.user_id, Cost(calendar.user_id)).add(calendar)
+    return Costs(
+        sorted(calendars, key=Cost.sort_key, reverse=True)[:top],
+        sorted(users.values(), key=Cost.sort_key, reverse=True)[:top],
+    )
+
+
+class Cost:
+    """
+    Average cost of the processing of the calendar or of all calendars of the user.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        """Calendar or user the cost is of"""
+        self.fetch_bytes = 0.0
+        """Average downloaded bytes"""
+        self.parse_time = 0.0
+        """Average seconds to parse the ical file and expand the events"""
+        self.instances = 0.0
+        """Average number of the expanded events"""
+        self.sends = 0.0
+        """Average number of the notifications"""
+
+    def add(self, calendar):
+        average = calendar.cost.average
+        self.fetch_bytes += average.get('fetch_bytes', 0)
+        self.parse_time += average.get('parse_time', 0)
+        self.instances += average.get('instances', 0)
+        self.sends += average.get('sends', 0)
+
+    def sort_key(self):
+        return self.parse_time, self.fetch_bytes
+
+    def __str__(self):
+        return COST_FORMAT.format(self.name, self.parse_time, self.fetch_bytes / 1024, self.instances, self.sends)
+
+
+class Costs:
+    """
+    Holds the most expensive calendars and users.
+    """
+
+    def __init__(self, calendars, users):
+        self.calendars = calendars
+        """List of Cost of the calendars, the most expensive first"""
+        self.users = users
+        """List of Cost of the users, the most expensive first"""
+
+    def __str__(self):
+        return COSTS_MESSAGE_FORMAT.format('\n'.join(map(str, self.calendars)) or '-',
+                                           '\n'.join(map(str, self.users)) or '-')
 
 
 class Stats:
@@ -110,21 +189,6 @@ class Stats:
         self.last_process_max = kwargs['last_process_max']
         """Timestamp of the calendar processed, max value"""
 
-    @classmethod
-    def load(cls, stats_config):
-        """
-        Loads stats from the stats.cfg file
-        """
-        parser = stats_config.read_parser()
-        return cls(
-            users=parser.getint('stats', 'users', fallback=0),
-            calendars=parser.getint('stats', 'calendars', fallback=0),
-            disabled_calendars=parser.getint('stats', 'disabled_calendars', fallback=0),
-            events=parser.getint('stats', 'events', fallback=0),
-            last_process_min=parser.get('stats', 'last_process_min', fallback=None),
-            last_process_max=parser.get('stats', 'last_process_max', fallback=None)
-        )
-
     def __str__(self):
         return STATS_MESSAGE_FORMAT.format(self.users,
                                            self.calendars,
@@ -132,16 +196,3 @@ class Stats:
                                            self.events,
                                            self.last_process_min,
                                            self.last_process_max)
-
-
-class StatsConfigFile(ConfigFile):
-    """
-    Reads and writes stats config file.
-    """
-
-    def __init__(self, vardir):
-        """
-        Creates the config
-        :param vardir: basic var dir
-        """
-        super().__init__(os.path.join(vardir, 'stats.cfg'))
@@ -18,19 +18,81 @@
 # along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
 
 
+import asyncio
 import datetime
+import io
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import unittest
 import pytz
 import shutil
+import tempfile
+import threading
+import urllib.request
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from dateutil.parser import parse
 
+import icalendar
 from icalendar.cal import Component
 
+from calbot import layout, metrics, processing
 from calbot.formatting import normalize_locale, format_event, strip_tags
-from calbot.conf import CalendarConfig, Config, UserConfig, UserConfigFile, DEFAULT_FORMAT, CalendarsConfigFile
-from calbot.ical import Event, Calendar, filter_notified_events, sort_events
-from calbot.stats import update_stats, get_stats
+from calbot.conf import CalendarConfig, Config, UserConfig, UserConfigFile, DEFAULT_FORMAT, CalendarsConfigFile, \
+    Journal, JournalFile
+from calbot.ical import Event, Calendar, CalendarReader, filter_notified_events, sort_events, read_calendar, \
+    parsed_calendars, parse_ical, iter_ical_components
+from calbot.processing import update_calendars, update_calendar, send_event, check_lateness
+from calbot.history import Record, StatsHistory
+from calbot.metrics import MetricsRegistry, MetricsServer
+from calbot.scheduler import NotificationScheduler
+from calbot.stats import update_stats, get_stats, get_costs
+
+
+PRUNE_ICAL = b"""BEGIN:VCALENDAR\r
+BEGIN:VEVENT\r
+UID:past\r
+DTSTART:20200101T100000Z\r
+DTEND:20200101T110000Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:current\r
+DTSTART;TZID=Asia/Omsk:20200301T100000\r
+BEGIN:VALARM\r
+TRIGGER:-PT15M\r
+END:VALARM\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:future\r
+DTSTART;VALUE=DATE:20210101\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:until\r
+DTSTART:20190101T100000Z\r
+RRULE:FREQ=WEEKLY;UNTIL=20190601T100000Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:count\r
+DTSTART:20190101T100000Z\r
+RRULE:FREQ=DAILY;COUNT=10\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:infinite\r
+DTSTART:20190101T100000Z\r
+RRULE:FREQ=YEARLY\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:moved\r
+RECURRENCE-ID:20200301T100000Z\r
+DTSTART:20200501T100000Z\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:folded\r
+DTSTART:2020\r
+ 0302T100000Z\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
 
 
 def _get_component():
@@ -41,8 +103,99 @@ def _get_component():
     return component
 
 
+class FakeBot:
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+class FakeContext:
+
+    def __init__(self):
+        self.bot = FakeBot()
+        self.bot_data = {}
+
+
+class FakeJobQueue:
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, name=None):
+        job = FakeJob(callback, when)
+        self.jobs.append(job)
+        return job
+
+
+class FakeJob:
+
+    def __init__(self, callback, when):
+        self.callback = callback
+        self.when = when
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class PicklingExecutor(ThreadPoolExecutor):
+    """
+    Checks the calls can be sent to a process pool.
+    """
+
+    def __init__(self):
+        super().__init__(1)
+        self.calls = []
+
+    def submit(self, fn, *args, **kwargs):
+        pickle.dumps((fn, args, kwargs))
+        self.calls.append(args)
+        return super().submit(fn, *args, **kwargs)
+
+
+class FilesHandler(SimpleHTTPRequestHandler):
+    statuses = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=os.path.join(os.path.dirname(__file__), 'test'), **kwargs)
+
+    def log_request(self, code='-', size='-'):
+        self.statuses.append(int(code))
+
+
 class CalbotTestCase(unittest.TestCase):
 
+    def setUp(self):
+        # calbot.cfg.sample keeps the state in the relative var directory,
+        # each test gets its own one and never touches the state of the checkout
+        sourcedir = os.path.dirname(os.path.abspath(__file__))
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        shutil.copy(os.path.join(sourcedir, 'calbot.cfg.sample'), workdir.name)
+        os.symlink(os.path.join(sourcedir, 'test'), os.path.join(workdir.name, 'test'))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(workdir.name)
+
+    def make_configfile(self, **bot_options):
+        """
+        Writes the config file with its own var directory
+        :param bot_options: additional options of the [bot] section
+        :return: path to the config file
+        """
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        vardir = os.path.join(tmpdir.name, 'var')
+        os.makedirs(vardir)
+        configfile = os.path.join(tmpdir.name, 'calbot.cfg')
+        with open(configfile, 'w') as f:
+            f.write('[bot]\ntoken = TOKEN\nvardir = {}\n'.format(vardir))
+            for name, value in bot_options.items():
+                f.write('{} = {}\n'.format(name, value))
+        return configfile
+
     def test_format_event(self):
         component = _get_component()
         component.add('dtstart', datetime.datetime(2016, 6, 23, 19, 50, 35, tzinfo=pytz.UTC))
@@ -261,6 +414,60 @@ class CalbotTestCase(unittest.TestCase):
         self.assertEqual(stats2.events, stats1.events)
         shutil.rmtree('var/TEST')
 
+    def test_stats_counters(self):
+        configfile = self.make_configfile()
+        config = Config(configfile)
+        update_stats(config)
+
+        def counters(stats):
+            return stats.users, stats.calendars, stats.disabled_calendars, stats.events
+
+        calendar = config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        config.add_calendar('TEST', 'http://localhost/repeat.ics', 'TEST')
+        config.add_calendar('TEST2', 'http://localhost/test.ics', 'TEST2')
+        config.enable_calendar('TEST', '2', False)
+        calendar.save_event_notified(Event(id='event1', title='Event 1', notified_for_advance=24))
+        calendar.save_event_notified(Event(id='event1', title='Event 1', notified_for_advance=1))
+        self.assertEqual((2, 2, 1, 1), counters(get_stats(config)))
+
+        update_stats(config)
+        self.assertEqual((2, 2, 1, 1), counters(get_stats(Config(configfile))))
+
+        config.delete_calendar('TEST2', '1')
+        calendar.compact_events()
+        config.enable_calendar('TEST', '1', False)
+        self.assertEqual((1, 0, 2, 0), counters(get_stats(config)))
+
+        config.enable_calendar('TEST', '1', True)
+        update_stats(config)
+        self.assertEqual((1, 1, 1, 1), counters(get_stats(Config(configfile))))
+
+        os.remove(os.path.join(config.vardir, 'stats.cfg'))
+        update_stats(config)
+        self.assertEqual((1, 1, 1, 1), counters(get_stats(config)))
+
+    def test_stats_history(self):
+        with tempfile.TemporaryDirectory() as vardir:
+            history = StatsHistory(vardir, capacity=3)
+            self.assertEqual([], history.records())
+            now = datetime.datetime.now().timestamp()
+            for i in range(5):
+                history.append(Record(time=now - (4 - i) * 3600, duration=i + 0.5, calendars=10 + i,
+                                      processed=i, failed=i % 2, sent=2 * i))
+
+            records = StatsHistory(vardir).records()
+            self.assertEqual([2.5, 3.5, 4.5], [record.duration for record in records])
+            self.assertEqual(14, records[-1].calendars)
+            self.assertEqual(3, len(StatsHistory(vardir).records(now - 2.5 * 3600)))
+            self.assertEqual(2, len(StatsHistory(vardir).records(now - 1.5 * 3600)))
+            self.assertEqual(os.path.getsize(history.path), os.path.getsize(StatsHistory(vardir, 100).path))
+
+            summary = history.summary('day', 24 * 3600)
+            self.assertEqual((3, 3.5, 4.5, 4.5), (summary.cycles, summary.duration_p50,
+                                                  summary.duration_p95, summary.duration_max))
+            self.assertEqual((14, 9, 1, 18), (summary.calendars, summary.processed, summary.failed, summary.sent))
+            self.assertIn('Last 24 hours: 3 cycles', history.summaries())
+
     def test_calendar_save_error(self):
         calendar_config = CalendarConfig.new(
             UserConfig.new(Config('calbot.cfg.sample'), 'TEST'),
@@ -727,3 +934,709 @@ class CalbotTestCase(unittest.TestCase):
         self.assertEqual(datetime.time(19, 0, 0, tzinfo=timezone), event.time)
         self.assertEqual('Дата Ужин (OML)', event.title)
         self.assertRegex(event.description, r'Пиццот')
+
+    def test_update_calendars_concurrently(self):
+        config = Config('calbot.cfg.sample')
+        config.concurrency = 2
+        url = 'file://{}/test/test.ics'.format(os.path.dirname(__file__))
+        for _ in range(3):
+            config.add_calendar('TEST', url, 'TEST')
+        context = FakeContext()
+
+        asyncio.run(update_calendars(context, config))
+
+        for calendar in config.load_calendars('TEST'):
+            self.assertTrue(calendar.verified)
+            self.assertEqual('Тест', calendar.name)
+        verified = [text for _, text in context.bot.messages if text.startswith('Verified calendar')]
+        self.assertEqual(3, len(verified))
+
+    def test_calendar_cost(self):
+        configfile = self.make_configfile(admins='1, 2')
+        config = Config(configfile)
+        self.assertEqual({'1', '2'}, config.admins)
+        test_ics = os.path.join(os.path.dirname(__file__), 'test', 'test.ics')
+        config.add_calendar('TEST', 'file://' + test_ics, 'TEST')
+        config.add_calendar('TEST2', 'file://' + test_ics, 'TEST2')
+        context = FakeContext()
+
+        calendar = config.load_calendar('TEST', '1')
+        self.assertTrue(asyncio.run(update_calendar(context, calendar)))
+        calendar.cost.average['parse_time'] = 0.5
+        self.assertTrue(asyncio.run(update_calendar(context, calendar)))
+        self.assertTrue(asyncio.run(update_calendar(context, config.load_calendar('TEST2', '1'))))
+
+        cost = config.load_calendar('TEST', '1').cost
+        self.assertEqual(os.path.getsize(test_ics), cost.last['fetch_bytes'])
+        self.assertEqual(os.path.getsize(test_ics), cost.average['fetch_bytes'])
+        self.assertGreater(cost.last['instances'], 0)
+        self.assertGreaterEqual(cost.last['sends'], 0)
+        self.assertAlmostEqual(0.4 + 0.2 * cost.last['parse_time'], cost.average['parse_time'], places=5)
+
+        costs = get_costs(config, 1)
+        self.assertEqual(['TEST /cal1 Тест'], [cost.name for cost in costs.calendars])
+        self.assertEqual(['TEST'], [cost.name for cost in costs.users])
+        self.assertRegex(str(costs), r'TEST /cal1 Тест — 0\.\d{3} s')
+
+    def test_update_calendars_reads_all_calendars_after_start(self):
+        configfile = self.make_configfile()
+        config = Config(configfile)
+        calendar = config.add_calendar('TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+        calendar.save_check(False)
+        self.assertFalse(calendar.check_due(datetime.datetime.utcnow()))
+        context = FakeContext()
+        scheduler = NotificationScheduler(FakeJobQueue())
+        context.bot_data['scheduler'] = scheduler
+
+        asyncio.run(update_calendars(context, config))
+        self.assertEqual(1, scheduler.generations[('TEST', '1')])
+        self.assertTrue(scheduler.primed)
+
+        asyncio.run(update_calendars(context, config))
+        self.assertEqual(1, scheduler.generations[('TEST', '1')])
+
+    def test_scheduler_notifies_in_time(self):
+        config = CalendarConfig.new(
+            UserConfig.new(Config('calbot.cfg.sample'), 'TEST'), '1', 'http://localhost/test.ics', 'TEST')
+        config.advance = [1]
+        now = datetime.datetime.now(tz=pytz.UTC)
+
+        def event(id, notify_datetime):
+            return Event(id=id, title=id, date=notify_datetime.date(), time=notify_datetime.timetz(),
+                         notify_datetime=notify_datetime)
+
+        calendar = Calendar.__new__(Calendar)
+        calendar.all_events = [event('soon', now + datetime.timedelta(minutes=30)),
+                               event('later', now + datetime.timedelta(hours=5))]
+        job_queue = FakeJobQueue()
+        scheduler = NotificationScheduler(job_queue)
+        context = FakeContext()
+
+        scheduler.schedule(config, calendar)
+        self.assertEqual(1, len(job_queue.jobs))
+        self.assertLessEqual(job_queue.jobs[0].when, datetime.datetime.now(tz=pytz.UTC))
+
+        asyncio.run(scheduler.notify_job(context))
+        self.assertEqual(1, len(context.bot.messages))
+        self.assertEqual(1, config.event('soon').last_notified)
+        self.assertEqual(now + datetime.timedelta(hours=4), job_queue.jobs[1].when)
+
+        scheduler.schedule(config, calendar)
+        scheduled = [(moment, event.id) for moment, _, key, generation, event, _ in scheduler.heap
+                     if scheduler.generations[key] == generation]
+        self.assertEqual([(now + datetime.timedelta(hours=4), 'later')], scheduled)
+        self.assertEqual(1, scheduler.stale)
+
+    def test_scheduler_schedules_during_send(self):
+        main_config = Config('calbot.cfg.sample')
+        user_config = UserConfig.new(main_config, 'TEST')
+        config = CalendarConfig.new(user_config, '1', 'http://localhost/test.ics', 'TEST')
+        config.advance = [1]
+        now = datetime.datetime.now(tz=pytz.UTC)
+        notify_datetime = now + datetime.timedelta(minutes=30)
+        calendar = Calendar.__new__(Calendar)
+        calendar.all_events = [Event(id='soon', title='soon', date=notify_datetime.date(),
+                                     time=notify_datetime.timetz(), notify_datetime=notify_datetime)]
+        job_queue = FakeJobQueue()
+        scheduler = NotificationScheduler(job_queue)
+        context = FakeContext()
+        send_message = context.bot.send_message
+
+        async def send_and_schedule(chat_id, text):
+            # the calendar is read again while the notification is sent
+            reread = CalendarConfig.new(user_config, '1', 'http://localhost/test.ics', 'TEST')
+            reread.advance = [1]
+            scheduler.schedule(reread, calendar)
+            await send_message(chat_id, text)
+
+        context.bot.send_message = send_and_schedule
+        scheduler.schedule(config, calendar)
+        asyncio.run(scheduler.notify_job(context))
+
+        self.assertEqual(1, len(context.bot.messages))
+        self.assertEqual(1, len(job_queue.jobs))
+        self.assertEqual({}, scheduler.in_flight)
+        self.assertEqual(1, scheduler.configs[('TEST', '1')].event('soon').last_notified)
+
+    def test_scheduler_applies_commands(self):
+        user_config = UserConfig.new(Config('calbot.cfg.sample'), 'TEST')
+        notify_datetime = datetime.datetime.now(tz=pytz.UTC) + datetime.timedelta(minutes=90)
+        calendar = Calendar.__new__(Calendar)
+        calendar.all_events = [Event(id='soon', title='soon', date=notify_datetime.date(),
+                                     time=notify_datetime.timetz(), notify_datetime=notify_datetime)]
+        scheduler = NotificationScheduler(FakeJobQueue())
+        context = FakeContext()
+        config1 = CalendarConfig.new(user_config, '1', 'http://localhost/test.ics', 'TEST')
+        config1.advance = [2, 1]
+        config2 = CalendarConfig.new(user_config, '2', 'http://localhost/test.ics', 'TEST')
+        config2.advance = [2]
+        scheduler.schedule(config1, calendar)
+        scheduler.schedule(config2, calendar)
+
+        scheduler.update_advance('TEST', [1])
+        scheduler.drop('TEST', '2')
+        asyncio.run(scheduler.notify_job(context))
+
+        self.assertEqual([], context.bot.messages)
+        self.assertEqual([('TEST', '1')], list(scheduler.configs))
+        self.assertIsNone(config1.event('soon').last_notified)
+
+    def test_notifications_lateness(self):
+        main_config = Config('calbot.cfg.sample')
+        main_config.admins = {'ADMIN'}
+        main_config.lateness_alert = 600
+        config = CalendarConfig.new(UserConfig.new(main_config, 'TEST'), '1', 'http://localhost/test.ics', 'TEST')
+        notify_datetime = datetime.datetime.now(tz=pytz.UTC) + datetime.timedelta(hours=1)
+        event = Event(id='late', title='late', date=notify_datetime.date(), time=notify_datetime.timetz(),
+                      notify_datetime=notify_datetime, notified_for_advance=2)
+        processing.notifications_lateness.take()
+        processing.notifications_lateness.alerted = False
+        count = metrics.lateness_seconds.count
+        context = FakeContext()
+
+        asyncio.run(send_event(context, config, event))
+        self.assertEqual(count + 1, metrics.lateness_seconds.count)
+        lateness = processing.notifications_lateness.take()
+        self.assertAlmostEqual(3600, lateness[0], delta=60)
+
+        asyncio.run(check_lateness(context, main_config, lateness))
+        asyncio.run(check_lateness(context, main_config, lateness))
+        asyncio.run(check_lateness(context, main_config, [10.0]))
+        alerts = [(chat_id, text) for chat_id, text in context.bot.messages if chat_id == 'ADMIN']
+        self.assertEqual(2, len(alerts))
+        self.assertRegex(alerts[0][1], r'^Notifications are late: p95 36\d\d s of 1 notifications')
+        self.assertRegex(alerts[1][1], r'^Notifications are in time again')
+
+    def test_calendar_check_interval_adapts(self):
+        config = Config('calbot.cfg.sample')
+        config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        calendar = config.load_calendar('TEST', '1')
+        self.assertEqual(900, calendar.check_interval)
+        self.assertTrue(calendar.check_due(datetime.datetime.utcnow()))
+
+        for _ in range(3):
+            calendar.save_check(False)
+        self.assertEqual(1800, calendar.check_interval)
+        calendar.save_check(None)
+        self.assertEqual(1800, calendar.check_interval)
+
+        calendar = config.load_calendar('TEST', '1')
+        self.assertEqual(1800, calendar.check_interval)
+        self.assertFalse(calendar.check_due(datetime.datetime.utcnow()))
+        self.assertTrue(calendar.check_due(datetime.datetime.utcnow() + datetime.timedelta(seconds=1800)))
+
+        calendar.save_check(True)
+        self.assertEqual(900, calendar.check_interval)
+        self.assertEqual(0, calendar.unchanged_checks)
+
+    def test_calendars_delayed_writes(self):
+        config = Config('calbot.cfg.sample')
+        config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+
+        with config.delayed_writes() as cycle_config:
+            # the registry loaded by the commands is reused, the users directories are not scanned again
+            for storage in (config.storage, cycle_config.storage):
+                storage.user_ids = lambda: self.fail('The users directories are scanned')
+            calendar = cycle_config.load_calendar('TEST', '1')
+            calendar.save_error(Exception('TEST ERROR'))
+            calendar.save_check(False)
+            self.assertIsNone(CalendarsConfigFile('var', 'TEST').read_parser().get('1', 'last_process_error', fallback=None))
+            self.assertEqual('TEST ERROR', cycle_config.load_calendar('TEST', '1').last_process_error)
+            self.assertEqual({'TEST'}, cycle_config.storage.dirty)
+
+            config.enable_calendar('TEST', '1', False)
+            self.assertEqual(set(), config.storage.dirty)
+            self.assertEqual('False', CalendarsConfigFile('var', 'TEST').read_parser().get('1', 'enabled'))
+
+        self.assertEqual(set(), cycle_config.storage.dirty)
+        parser = CalendarsConfigFile('var', 'TEST').read_parser()
+        self.assertEqual('TEST ERROR', parser.get('1', 'last_process_error'))
+        self.assertEqual('1', parser.get('1', 'unchanged_checks'))
+        self.assertEqual('False', parser.get('1', 'enabled'))
+
+        calendar.save_check(False)
+        self.assertEqual('2', CalendarsConfigFile('var', 'TEST').read_parser().get('1', 'unchanged_checks'))
+
+    def test_events_ledger(self):
+        config = Config('calbot.cfg.sample')
+        calendar = config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        calendar.save_event_notified(Event(id='event1', title='Event 1', notified_for_advance=24))
+        calendar.save_event_notified(Event(id='event 2', title='Event 2', notified_for_advance=48))
+        calendar.save_event_notified(Event(id='event1', title='Event 1', notified_for_advance=1))
+        self.assertFalse(os.path.exists('var/TEST/1/events.cfg'))
+        with open('var/TEST/1/events.log', 'a') as f:
+            f.write('24 incomplete')
+
+        calendar = next(config.all_calendars())
+        self.assertEqual(1, calendar.event('event1').last_notified)
+        self.assertEqual(48, calendar.event('event 2').last_notified)
+        self.assertNotIn('incomplete', calendar.events)
+
+        calendar.compact_events()
+        self.assertFalse(os.path.exists('var/TEST/1/events.log'))
+        calendar = next(config.all_calendars())
+        self.assertEqual(1, calendar.event('event1').last_notified)
+        self.assertEqual(48, calendar.event('event 2').last_notified)
+
+    def test_compact_expired_events(self):
+        config = Config('calbot.cfg.sample')
+        calendar = config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        now = datetime.datetime.now(tz=pytz.UTC)
+        for id, days in (('old', -10), ('old_kept', -10), ('recent', -1), ('future', 1)):
+            calendar.save_event_notified(Event(id=id, title=id, notified_for_advance=24,
+                                               notify_datetime=now + datetime.timedelta(days=days)))
+        calendar.save_event_notified(Event(id='long', title='long', notified_for_advance=24,
+                                           notify_datetime=now - datetime.timedelta(days=10),
+                                           end=now + datetime.timedelta(days=1)))
+        calendar.event('unnotified')
+        for days in (-10, 1):
+            event_id = 'legacy_%s' % (now + datetime.timedelta(days=days)).isoformat()
+            calendar.save_event_notified(Event(id=event_id, title='legacy', notified_for_advance=24))
+        calendar.save_event_notified(Event(id='legacy_no_date', title='legacy', notified_for_advance=24))
+
+        dropped = calendar.compact_events(now - datetime.timedelta(days=7), ['old_kept'])
+
+        self.assertEqual(2, dropped)
+        calendar = next(config.all_calendars())
+        self.assertEqual({'old_kept', 'recent', 'future', 'long', 'legacy_no_date',
+                          'legacy_%s' % (now + datetime.timedelta(days=1)).isoformat()}, set(calendar.events))
+        self.assertEqual(now + datetime.timedelta(days=1), calendar.event('future').notify_datetime)
+
+    def test_events_loaded_lazily(self):
+        config = Config('calbot.cfg.sample')
+        calendar = config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        calendar.save_event_notified(Event(id='event1', title='Event 1', notified_for_advance=24))
+        calendar.save_event_notified(Event(id='event2', title='Event 2', notified_for_advance=24))
+        calendar.compact_events()
+
+        calendar = next(config.all_calendars())
+        os.remove('var/TEST/1/events.cfg')
+        self.assertEqual(2, calendar.events_count)
+        self.assertEqual({}, calendar.events)
+        self.assertEqual(0, calendar.events_count)
+
+        calendar = next(config.all_calendars())
+        calendar.event('event3').last_notified = 1
+        self.assertEqual(1, calendar.events_count)
+
+    def test_journal(self):
+        vardir = tempfile.mkdtemp()
+        config_file = CalendarsConfigFile(vardir, 'TEST')
+        parser = config_file.read_parser()
+        parser.read_dict({'1': {'url': 'http://localhost/1.ics'}})
+        config_file.write(parser)
+        self.assertEqual(['calendars.cfg'], os.listdir(os.path.join(vardir, 'TEST')))
+
+        feed_path = os.path.join(vardir, 'TEST', 'feed.ics')
+        with Journal(vardir) as journal:
+            with open(feed_path + '.tmp', 'wt') as f:
+                f.write('feed')
+            journal.replace(feed_path + '.tmp', feed_path)
+            parser.read_dict({'1': {'hash': 'abc'}})
+            journal.write(config_file, parser)
+        self.assertEqual('abc', config_file.read_parser().get('1', 'hash'))
+        self.assertEqual([], os.listdir(os.path.join(vardir, 'journal')))
+
+        # the process is killed after the journal is saved
+        journal = Journal(vardir)
+        parser.read_dict({'1': {'hash': 'def'}})
+        journal.write(config_file, parser)
+        JournalFile(journal.directory).write(journal.replacements)
+        self.assertEqual('abc', config_file.read_parser().get('1', 'hash'))
+        configfile = os.path.join(vardir, 'calbot.cfg')
+        with open(configfile, 'w') as f:
+            f.write('[bot]\ntoken = TOKEN\nvardir = {}\n'.format(vardir))
+        Config(configfile)
+        self.assertEqual('abc', config_file.read_parser().get('1', 'hash'))
+        self.assertEqual(1, Journal.recover(vardir))
+        self.assertEqual('def', config_file.read_parser().get('1', 'hash'))
+        self.assertEqual([], os.listdir(os.path.join(vardir, 'journal')))
+        shutil.rmtree(vardir)
+
+    def test_calendars_registry(self):
+        configfile = self.make_configfile()
+        config = Config(configfile)
+        config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        config.add_calendar('TEST', 'http://localhost/repeat.ics', 'TEST')
+        config.add_calendar('TEST2', 'http://localhost/test.ics', 'TEST2')
+        config.enable_calendar('TEST', '2', False)
+        config.delete_calendar('TEST2', '1')
+
+        def registry(config):
+            return sorted((entry.user_id, entry.cal_id, entry.enabled) for entry in config.storage.registry())
+
+        expected = [('TEST', '1', True), ('TEST', '2', False)]
+        self.assertEqual(expected, registry(config))
+        self.assertEqual(expected, registry(Config(configfile)))
+
+        # only the changes of the indexed options rewrite the registry
+        writes = []
+        calendars_registry = config.storage.calendars_registry
+        write = calendars_registry.write
+        calendars_registry.write = lambda: writes.append(True) or write()
+        calendar = config.load_calendar('TEST', '1')
+        calendar.save_error(Exception('TEST ERROR'))
+        calendar.save_cost(fetch_bytes=100)
+        calendar.save_check(True)
+        self.assertEqual(1, len(writes))
+
+        os.remove(os.path.join(config.vardir, 'registry.cfg'))
+        self.assertEqual(expected, registry(Config(configfile)))
+
+        os.makedirs(os.path.join(config.vardir, 'TEST3'))
+        with open(os.path.join(config.vardir, 'TEST3', 'calendars.cfg'), 'w') as f:
+            f.write('[1]\nurl = http://localhost/test.ics\nchannel_id = TEST3\n')
+        self.assertEqual(expected + [('TEST3', '1', True)], registry(Config(configfile)))
+
+    def test_calendars_changed_by_another_process(self):
+        configfile = self.make_configfile()
+        worker = Config(configfile)
+        commands = Config(configfile)
+        commands.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        worker.storage.registry()
+
+        commands.add_calendar('TEST', 'http://localhost/repeat.ics', 'TEST')
+        worker.enable_calendar('TEST', '1', False)
+        self.assertEqual(['1', '2'], [calendar.id for calendar in commands.load_calendars('TEST')])
+
+        with worker.delayed_writes() as cycle_worker:
+            calendar = cycle_worker.load_calendar('TEST', '2')
+            commands.change_calendar_url('TEST', '2', 'http://localhost/new.ics')
+            commands.delete_calendar('TEST', '1')
+            calendar.save_check(True)
+
+        calendars = list(Config(configfile).load_calendars('TEST'))
+        self.assertEqual(['2'], [calendar.id for calendar in calendars])
+        self.assertEqual('http://localhost/new.ics', calendars[0].url)
+        self.assertIsNotNone(calendars[0].next_check_at)
+        self.assertEqual([('TEST', '2')], [(entry.user_id, entry.cal_id)
+                                           for entry in Config(configfile).storage.registry()])
+        self.assertEqual([('TEST', '2')], [(entry.user_id, entry.cal_id)
+                                           for entry in worker.storage.registry()])
+
+    def test_deleted_calendar_not_recreated(self):
+        configfile = self.make_configfile()
+        config = Config(configfile)
+        config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        config.add_calendar('TEST', 'http://localhost/repeat.ics', 'TEST')
+        calendar = config.load_calendar('TEST', '1')
+
+        with config.delayed_writes() as cycle_config:
+            cycle_calendars = list(cycle_config.load_calendars('TEST'))
+            config.delete_calendar('TEST', '1')
+            self.assertEqual(['2'], [c.id for c in Config(configfile).load_calendars('TEST')])
+            for cycle_calendar in cycle_calendars:
+                cycle_calendar.save_check(True)
+
+        self.assertEqual(['2'], [c.id for c in Config(configfile).load_calendars('TEST')])
+        calendar.save_error(Exception('TEST ERROR'))
+        cycle_calendars[0].save_cost(fetch_bytes=100)
+        calendars = list(Config(configfile).load_calendars('TEST'))
+        self.assertEqual(['2'], [c.id for c in calendars])
+        self.assertIsNotNone(calendars[0].next_check_at)
+
+    def test_sharded_layout(self):
+        configfile = self.make_configfile()
+        config = Config(configfile)
+        calendar = config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        calendar.event('event1').last_notified = 1
+        calendar.save_events()
+        config.load_user('TEST2').set_advance([3])
+
+        self.assertEqual(2, layout.migrate(config.vardir))
+
+        self.assertFalse(os.path.exists(os.path.join(config.vardir, 'TEST')))
+        self.assertFalse(os.path.exists(os.path.join(config.vardir, 'TEST2')))
+        user_dir = layout.user_dir(config.vardir, 'TEST')
+        self.assertEqual(os.path.join(config.vardir, 'users', *layout.shard('TEST'), 'TEST'), user_dir)
+        self.assertEqual(user_dir, layout._sharded_dirs[(config.vardir, 'TEST')])
+        self.assertTrue(os.path.exists(os.path.join(user_dir, '1', 'events.cfg')))
+        config = Config(configfile)
+        config.add_calendar('TEST3', 'http://localhost/test.ics', 'TEST3')
+        self.assertFalse(os.path.exists(os.path.join(config.vardir, 'TEST3')))
+        self.assertEqual(['TEST', 'TEST2', 'TEST3'], sorted(config.storage.user_ids()))
+        self.assertEqual([3], config.load_user('TEST2').advance)
+        calendars = sorted(config.all_calendars(), key=lambda calendar: calendar.user_id)
+        self.assertEqual(['TEST', 'TEST3'], [calendar.user_id for calendar in calendars])
+        self.assertEqual(1, calendars[0].event('event1').last_notified)
+
+    def test_sqlite_storage_migrates_files(self):
+        configfile = self.make_configfile()
+        config = Config(configfile)
+        calendar = config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        config.load_user('TEST').set_advance([3, 1])
+        calendar.event('event1').last_notified = 1
+        calendar.save_events()
+        calendar.save_event_notified(Event(id='event2', title='Event 2', notified_for_advance=3))
+
+        with open(configfile, 'a') as f:
+            f.write('storage = sqlite\n')
+        config = Config(configfile)
+
+        self.assertEqual(['TEST'], config.storage.user_ids())
+        self.assertEqual([3, 1], config.load_user('TEST').advance)
+        calendars = list(config.all_calendars())
+        self.assertEqual(['1'], [calendar.id for calendar in calendars])
+        self.assertEqual('http://localhost/test.ics', calendars[0].url)
+        self.assertEqual(1, calendars[0].event('event1').last_notified)
+        self.assertEqual(3, calendars[0].event('event2').last_notified)
+
+        calendar = config.add_calendar('TEST', 'http://localhost/repeat.ics', 'TEST')
+        self.assertEqual('2', calendar.id)
+        config.delete_calendar('TEST', '1')
+        calendar.save_check(True)
+        calendars = list(Config(configfile).all_calendars())
+        self.assertEqual(['2'], [calendar.id for calendar in calendars])
+        self.assertEqual(calendar.next_check_at, calendars[0].next_check_at)
+        config.storage.close()
+
+    def test_sqlite_storage_retries_failed_import(self):
+        configfile = self.make_configfile()
+        config = Config(configfile)
+        config.add_calendar('TEST', 'http://localhost/test.ics', 'TEST')
+        config.add_calendar('TEST2', 'http://localhost/test.ics', 'TEST2')
+        broken_path = CalendarsConfigFile(config.vardir, 'TEST2').path
+        with open(broken_path) as f:
+            content = f.read()
+        with open(broken_path, 'w') as f:
+            f.write('not a section\n' + content)
+
+        with open(configfile, 'a') as f:
+            f.write('storage = sqlite\n')
+        with self.assertRaises(Exception):
+            Config(configfile)
+
+        with open(broken_path, 'w') as f:
+            f.write(content)
+        config = Config(configfile)
+        self.assertTrue(config.storage.imported)
+        self.assertEqual(['TEST', 'TEST2'], sorted(config.storage.user_ids()))
+        config.storage.close()
+
+    def test_update_calendar_with_sqlite_storage(self):
+        configfile = self.make_configfile(storage='sqlite')
+        config = Config(configfile)
+        config.add_calendar('TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+        context = FakeContext()
+
+        calendar = config.load_calendar('TEST', '1')
+        self.assertTrue(asyncio.run(update_calendar(context, calendar)))
+        self.assertTrue(asyncio.run(update_calendar(context, config.load_calendar('TEST', '1'))))
+
+        calendar = config.load_calendar('TEST', '1')
+        self.assertTrue(calendar.verified)
+        notified = set(text for _, text in context.bot.messages if text.startswith('Daily event'))
+        self.assertEqual(2, len(notified))
+        self.assertEqual(2, calendar.events_count)
+        config.storage.close()
+
+    def test_read_calendar_in_process_pool(self):
+        config = CalendarConfig.new(
+            UserConfig.new(Config('calbot.cfg.sample'), 'TEST'),
+            '1', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+
+        with ProcessPoolExecutor(1) as executor:
+            calendar = asyncio.run(read_calendar(config, executor))
+
+        self.assertEqual(pytz.timezone('Asia/Omsk'), calendar.timezone)
+        self.assertEqual('Тест', calendar.name)
+        self.assertEqual(2, len(calendar.all_events))
+
+    def test_update_calendar_in_process_pool_with_sqlite_storage(self):
+        configfile = self.make_configfile(storage='sqlite')
+        config = Config(configfile)
+        config.add_calendar('TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+        context = FakeContext()
+
+        with ProcessPoolExecutor(1) as executor:
+            context.bot_data['executor'] = executor
+            self.assertTrue(asyncio.run(update_calendar(context, config.load_calendar('TEST', '1'))))
+
+        self.assertEqual(2, config.load_calendar('TEST', '1').events_count)
+        config.storage.close()
+
+    def test_read_calendar_sends_plain_data_to_executor(self):
+        config = CalendarConfig.new(
+            UserConfig.new(Config('calbot.cfg.sample'), 'TEST'),
+            '1', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+        config.event('notified').last_notified = 24
+
+        with PicklingExecutor() as executor:
+            calendar = asyncio.run(read_calendar(config, executor))
+
+        self.assertEqual(2, len(executor.calls))
+        self.assertFalse(any(isinstance(arg, CalendarConfig) for args in executor.calls for arg in args))
+        self.assertEqual(2, len(calendar.all_events))
+        self.assertEqual([event.id for event in filter_notified_events(calendar.all_events, config)],
+                         [event.id for event in calendar.events])
+
+    def test_read_calendar_not_modified(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FilesHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        FilesHandler.statuses.clear()
+        config = CalendarConfig.new(
+            UserConfig.new(Config('calbot.cfg.sample'), 'TEST'),
+            '1', 'http://127.0.0.1:{}/test.ics'.format(server.server_port), 'TEST')
+        try:
+            calendar1 = asyncio.run(read_calendar(config))
+            self.assertIsNotNone(config.load_feed().last_modified)
+            calendar2 = asyncio.run(read_calendar(config))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual([200, 304], FilesHandler.statuses)
+        self.assertEqual('Тест', calendar2.name)
+        self.assertEqual(len(calendar1.all_events), len(calendar2.all_events))
+
+    def test_calendar_reader_reads_url_once(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FilesHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        FilesHandler.statuses.clear()
+        url = 'http://127.0.0.1:{}/test.ics'.format(server.server_port)
+        user_config = UserConfig.new(Config('calbot.cfg.sample'), 'TEST')
+        config1 = CalendarConfig.new(user_config, '1', url, 'TEST')
+        config1.advance = [24]
+        config2 = CalendarConfig.new(user_config, '2', url, 'TEST')
+        config2.advance = [48, 24]
+
+        async def read_all():
+            reader = CalendarReader([config1, config2])
+            return await asyncio.gather(reader.read(config1), reader.read(config2))
+
+        try:
+            calendar1, calendar2 = asyncio.run(read_all())
+            self.assertEqual([200], FilesHandler.statuses)
+            self.assertTrue(calendar1.changed)
+            self.assertEqual(calendar2.hash, config1.load_feed().hash)
+
+            # the calendar is read for itself, e.g. the other one is disabled
+            calendar1 = asyncio.run(CalendarReader([config1]).read(config1))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual([200, 200], FilesHandler.statuses)
+        self.assertFalse(calendar1.changed)
+        self.assertEqual('Тест', calendar1.name)
+        self.assertEqual(1, len(calendar1.all_events))
+        self.assertEqual(2, len(calendar2.all_events))
+        self.assertIsNot(calendar1.all_events[0], calendar2.all_events[0])
+
+    def test_read_calendar_same_content_parsed_once(self):
+        main_config = Config('calbot.cfg.sample')
+        self.assertEqual((64, 256), (main_config.parsed_cache_size, main_config.expanded_cache_size))
+        config = CalendarConfig.new(
+            UserConfig.new(main_config, 'TEST'),
+            '1', 'file://{}/test/repeat.ics'.format(os.path.dirname(__file__)), 'TEST')
+        parsed_calendars.values.clear()
+        hits, misses = parsed_calendars.hits, parsed_calendars.misses
+
+        calendar1 = asyncio.run(read_calendar(config))
+        calendar2 = asyncio.run(read_calendar(config))
+
+        self.assertEqual(1, parsed_calendars.misses - misses)
+        self.assertEqual(1, parsed_calendars.hits - hits)
+        self.assertEqual(calendar1.name, calendar2.name)
+        self.assertEqual(calendar1.timezone, calendar2.timezone)
+
+    def test_metrics(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('test_seconds', 'Test time.', (0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        errors = registry.counter('test_errors_total', 'Test errors.', ('error',))
+        errors.inc(error='ValueError')
+        text = registry.render()
+        self.assertIn('# TYPE test_seconds histogram\n', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('test_seconds_count 2\n', text)
+        self.assertIn('test_errors_total{error="ValueError"} 1\n', text)
+
+        server = MetricsServer('127.0.0.1', 0, registry)
+        server.start()
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%s/metrics' % server.port) as response:
+                self.assertEqual(text, response.read().decode('UTF-8'))
+        finally:
+            server.stop()
+
+        config = CalendarConfig.new(
+            UserConfig.new(Config('calbot.cfg.sample'), 'TEST'),
+            '1', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+        fetches, fetched = metrics.fetch_seconds.count, metrics.fetched_bytes.value()
+        expansions = metrics.expand_seconds.count
+        asyncio.run(read_calendar(config))
+        self.assertEqual(1, metrics.fetch_seconds.count - fetches)
+        self.assertEqual(os.path.getsize('test/test.ics'), metrics.fetched_bytes.value() - fetched)
+        self.assertEqual(1, metrics.expand_seconds.count - expansions)
+
+    def test_iter_ical_components(self):
+        components = list(iter_ical_components(io.BytesIO(PRUNE_ICAL)))
+        self.assertEqual(['VCALENDAR'] + ['VEVENT'] * 8 + ['VCALENDAR'], [name for name, _ in components])
+        self.assertEqual([b'BEGIN:VCALENDAR\r\n'], components[0][1])
+        self.assertEqual(7, len(components[2][1]))
+        with self.assertRaises(ValueError):
+            list(iter_ical_components(io.BytesIO(PRUNE_ICAL), max_size=100))
+
+    def test_parse_ical(self):
+        vcalendar = parse_ical(io.BytesIO(PRUNE_ICAL),
+                               datetime.datetime(2020, 3, 1, 0, 0, 0, tzinfo=pytz.UTC),
+                               datetime.datetime(2020, 3, 3, 0, 0, 0, tzinfo=pytz.UTC))
+        uids = [str(event.get('UID')) for event in vcalendar.walk('VEVENT')]
+        self.assertEqual(['current', 'infinite', 'moved', 'folded'], uids)
+        self.assertEqual(1, len(vcalendar.walk('VALARM')))
+
+    def test_parse_ical_timezone_after_event(self):
+        ical = b'\r\n'.join([
+            b'BEGIN:VCALENDAR', b'VERSION:2.0',
+            b'BEGIN:VEVENT', b'UID:zoned', b'DTSTART;TZID="Test/', b' Zone":20200302T100000', b'END:VEVENT',
+            b'BEGIN:VEVENT', b'UID:utc', b'DTSTART:20200302T100000Z', b'END:VEVENT',
+            b'BEGIN:VTIMEZONE', b'TZID:Test/Zone',
+            b'BEGIN:STANDARD', b'DTSTART:19700101T000000', b'TZOFFSETFROM:+0500', b'TZOFFSETTO:+0500',
+            b'END:STANDARD', b'END:VTIMEZONE',
+            b'END:VCALENDAR', b''])
+        vcalendar = parse_ical(io.BytesIO(ical),
+                               datetime.datetime(2020, 3, 1, 0, 0, 0, tzinfo=pytz.UTC),
+                               datetime.datetime(2020, 3, 3, 0, 0, 0, tzinfo=pytz.UTC))
+        starts = {str(event.get('UID')): event.get('DTSTART').dt for event in vcalendar.walk('VEVENT')}
+        self.assertEqual(datetime.datetime(2020, 3, 2, 5, 0, 0, tzinfo=pytz.UTC), starts['zoned'])
+        self.assertEqual(datetime.datetime(2020, 3, 2, 10, 0, 0, tzinfo=pytz.UTC), starts['utc'])
+
+    def test_read_ical_expands_new_period_only(self):
+        config = CalendarConfig.new(
+            UserConfig.new(Config('calbot.cfg.sample'), 'TEST'),
+            '1', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+        with open('test/test.ics', 'rb') as f:
+            vcalendar = icalendar.Calendar.from_ical(f.read())
+        calendar = Calendar(config, vcalendar)
+        after = datetime.datetime(2017, 2, 1, 4, 30, 0, tzinfo=pytz.UTC)
+        before = datetime.datetime(2017, 2, 5, 0, 0, 0, tzinfo=pytz.UTC)
+
+        list(calendar.read_ical(config.url, datetime.datetime(2017, 2, 1, 0, 0, 0, tzinfo=pytz.UTC),
+                                datetime.datetime(2017, 2, 3, 0, 0, 0, tzinfo=pytz.UTC), vcalendar))
+        events = list(calendar.read_ical(config.url, after, before, vcalendar, calendar.expansion))
+        all_events = list(calendar.read_ical(config.url, after, before, vcalendar))
+
+        self.assertEqual(4, len(events))
+        self.assertEqual(sorted(event.id for event in all_events), sorted(event.id for event in events))
+        self.assertEqual(before, calendar.expansion.until)
+
+    def test_read_ical_narrower_expansion_keeps_wider_events(self):
+        user_config = UserConfig.new(Config('calbot.cfg.sample'), 'TEST')
+        url = 'file://{}/test/test.ics'.format(os.path.dirname(__file__))
+        wide = CalendarConfig.new(user_config, '1', url, 'TEST')
+        wide.advance = [48]
+        narrow = CalendarConfig.new(user_config, '2', url, 'TEST')
+        narrow.advance = [24]
+        with open('test/test.ics', 'rb') as f:
+            vcalendar = icalendar.Calendar.from_ical(f.read())
+
+        first = Calendar(wide, vcalendar)
+        second = Calendar(narrow, vcalendar, first.expansion)
+        third = Calendar(wide, vcalendar, second.expansion)
+
+        self.assertEqual(2, len(first.all_events))
+        self.assertLess(len(second.all_events), len(first.all_events))
+        self.assertEqual([event.id for event in first.all_events], [event.id for event in third.all_events])